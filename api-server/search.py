@@ -80,7 +80,17 @@ def search(
     limit,
     with_answer,
 ):
-    # Build filters
+    # Build filters, the data server takes times in whole seconds
+    filters = {
+        "by": by,
+        "before_time": int(before_time) if before_time else None,
+        "after_time": int(after_time) if after_time else None,
+        "min_score": min_score,
+        "max_score": max_score,
+        "min_comments": min_comments,
+        "max_comments": max_comments,
+    }
+    filters = {key: value for key, value in filters.items() if value}
     query_filters = []
     if by:
         query_filters.append(Item.by == by)
@@ -97,11 +107,9 @@ def search(
     if max_comments:
         query_filters.append(Item.descendants <= max_comments)
 
-    # Perform semantic search
+    # Perform semantic search, filters are applied by the data server
     top_k = 100
-    if len(query_filters) > 0:
-        top_k = 1000
-    results = semantic_search(url, session, query, top_k=top_k)
+    results = semantic_search(url, session, query, top_k=top_k, filters=filters)
     ids = [story_id for _, story_id in results["results"]]
     times = {
         "search_time": results["search_time"],
@@ -147,18 +155,19 @@ def search(
     )
 
 
-def semantic_search(url, session, query, top_k=100):
+def semantic_search(url, session, query, top_k=100, filters=None):
     query = query.strip()
 
     # Perform semantic search
     start = time.time()
-    req = requests.get(url, params={"query": query, "top_k": top_k})
+    req = requests.get(url, params={"query": query, "top_k": top_k, **(filters or {})})
     results = req.json()
+    metric = req.headers.get("X-Search-Metric", "l2")
     search_time = time.time() - start
 
     # Rank results
     start = time.time()
-    results = compute_rankings(session, query, results)
+    results = compute_rankings(session, query, results, metric)
     rank_time = time.time() - start
 
     return {
@@ -182,7 +191,7 @@ def normalize(values, reverse=False):
     return normalized_values
 
 
-def compute_rankings(session, query, results):
+def compute_rankings(session, query, results, metric="l2"):
     expanded = []
     for story_id, distance in results:
         cursor = session.execute(
@@ -199,9 +208,12 @@ def compute_rankings(session, query, results):
         expanded.append((story_id, distance, title, score, published))
         cursor.close()
 
+    if not expanded:
+        return []
     _, distances, _, scores, pub_times = zip(*expanded)
     normalized_scores = normalize(scores)
-    normalized_distances = normalize(distances, reverse=True)
+    # Cosine similarities grow with relevance, L2 distances shrink
+    normalized_distances = normalize(distances, reverse=metric != "cosine")
 
     now = time.time()
     recencies = [now - t for t in pub_times]
@@ -0,0 +1,58 @@
+import os
+import sys
+import tempfile
+
+import pytest
+import tiktoken
+
+from sqlalchemy import create_engine
+
+API_SERVER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class DataServerResponse:
+    headers = {"X-Search-Metric": "l2"}
+
+    def json(self):
+        return []
+
+
+@pytest.fixture
+def api(monkeypatch):
+    # The data server has modules of the same names
+    monkeypatch.syspath_prepend(API_SERVER)
+    for name in ("main", "search", "schema", "utils"):
+        monkeypatch.delitem(sys.modules, name, raising=False)
+    import schema
+
+    db_path = os.path.join(tempfile.mkdtemp(), "hn.db")
+    schema.Base.metadata.create_all(bind=create_engine(f"sqlite:///{db_path}"))
+    monkeypatch.setenv("DB_PATH", db_path)
+    # Only warmed up at startup, loading it downloads the vocabulary
+    monkeypatch.setattr(tiktoken, "get_encoding", lambda name: None)
+    import main
+    import search
+
+    requests = []
+
+    def get(url, params):
+        requests.append(params)
+        return DataServerResponse()
+
+    monkeypatch.setattr(search.requests, "get", get)
+    return main, requests
+
+
+def test_time_filters_are_whole_seconds(api):
+    from fastapi.testclient import TestClient
+
+    main, requests = api
+    response = TestClient(main.app).get(
+        "/items", params={"query": "rust compilers", "before_time": "last week"}
+    )
+    assert response.status_code == 200
+    params = requests[0]
+    # The data server declares both as int query parameters
+    for name in ("before_time", "after_time"):
+        assert str(params[name]).isdigit()
+    assert params["before_time"] - params["after_time"] > 360 * 24 * 3600
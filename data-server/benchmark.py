@@ -0,0 +1,221 @@
+import gc
+import os
+import re
+import json
+import time
+import sqlite3
+import itertools
+import numpy as np
+import faiss
+
+import store
+import search
+from utils import log, log_with_mem
+
+OPTS = os.getenv("OPTS")
+DB_PATH = os.getenv("DB_PATH")
+INDEX_TYPES = ["ivfflat", "hnsw", "ivfhnsw"]
+CACHE_FILE = "embedder_cache.jsonl"
+PERTURBATIONS = 20
+NOISE = 0.3
+
+
+def get_opt(name, default, cast=int):
+    # Multiple values are separated by "+", e.g. OPTS=nprobe=8+35+64
+    match = re.search(rf"(?:^|,){name}=([^,]+)", OPTS or "")
+    if not match:
+        return default
+    values = match.group(1).split("+")
+    return [cast(v) for v in values] if isinstance(default, list) else cast(values[0])
+
+
+def load_sample(vector_store, num_base, num_queries, seed=1234):
+    # Held-out rows of the embeddings table serve as queries
+    vector_store.sync()
+    vectors, story_ids = vector_store.load()
+    num_base = min(num_base, len(story_ids) - num_queries)
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(story_ids), num_base + num_queries, replace=False)
+    base_rows, query_rows = np.sort(rows[:num_base]), np.sort(rows[num_base:])
+    return vectors[base_rows], story_ids[base_rows], vectors[query_rows]
+
+
+def load_cached_queries(num_perturbations=PERTURBATIONS, noise=NOISE, seed=1234):
+    # Real user queries plus noisy copies, renormalized like OpenAI embeddings
+    cache_file = os.path.join(os.path.dirname(__file__), CACHE_FILE)
+    if not os.path.exists(cache_file):
+        return np.empty((0, search.Index.EMBEDDING_DIM), dtype=np.float32)
+    with open(cache_file, "r", encoding="utf-8") as f:
+        queries = np.array(
+            [json.loads(line)["embedding"] for line in f if line.strip()],
+            dtype=np.float32,
+        )
+
+    rng = np.random.default_rng(seed)
+    perturbed = np.repeat(queries, num_perturbations, axis=0)
+    perturbed += rng.standard_normal(perturbed.shape, dtype=np.float32) * (
+        noise / np.sqrt(queries.shape[1])
+    )
+    perturbed /= np.linalg.norm(perturbed, axis=1, keepdims=True)
+    return np.vstack([queries, perturbed])
+
+
+def ground_truth(embeddings, item_ids, queries, top_k):
+    index = faiss.IndexFlatL2(embeddings.shape[1])
+    index.add(embeddings)
+    _, I = index.search(queries, top_k)
+    return item_ids[I]
+
+
+def recall_at_k(results, truth):
+    # Story level, since search results are deduplicated by story anyway
+    recalls = [
+        len(set(found) & set(expected)) / len(set(expected))
+        for found, expected in zip(results, truth)
+    ]
+    return float(np.mean(recalls))
+
+
+def measure(index, queries, truth, top_k):
+    latencies = np.empty(len(queries))
+    results = np.empty((len(queries), top_k), dtype=np.int64)
+    for i in range(len(queries)):
+        start = time.perf_counter()
+        _, I = index.search(queries[i : i + 1], top_k)
+        latencies[i] = time.perf_counter() - start
+        results[i] = I[0]
+
+    # Throughput with all queries in one batch, as faiss would parallelize them
+    start = time.perf_counter()
+    index.search(queries, top_k)
+    batch_time = time.perf_counter() - start
+
+    return {
+        "qps": len(queries) / batch_time,
+        "p50": np.percentile(latencies, 50) * 1000,
+        "p99": np.percentile(latencies, 99) * 1000,
+        "recall": recall_at_k(results, truth),
+    }
+
+
+class Reranked:
+    # Index.search_rerank for Matryoshka mode and refined types, returning
+    # the closest chunks
+    def __init__(self, index, coarse_dim, embeddings, item_ids, metric):
+        self.index = index
+        self.coarse_dim = coarse_dim
+        self.metric = metric
+        self.embeddings = embeddings
+        self.item_ids = item_ids
+        self.story_rows = store.StoryRows(item_ids)
+
+    def search(self, queries, top_k):
+        fetch = max(search.Index.RERANK_CANDIDATES, top_k * search.Index.OVERFETCH)
+        _, I = self.index.search(
+            search.Index.truncate(queries, self.coarse_dim),
+            min(fetch, self.index.ntotal),
+        )
+        D_out = np.full((len(queries), top_k), np.inf, dtype=np.float32)
+        I_out = np.full((len(queries), top_k), -1, dtype=np.int64)
+        for i, (query, chunk_ids) in enumerate(zip(queries, I)):
+            rows = self.story_rows.lookup(np.unique(chunk_ids[chunk_ids >= 0]))
+            distances = search.Index.exact_distances(
+                query[None], self.embeddings[rows], self.metric
+            )[0]
+            top = np.argsort(distances, kind="stable")[:top_k]
+            D_out[i, : len(top)] = distances[top]
+            I_out[i, : len(top)] = self.item_ids[rows[top]]
+        return D_out, I_out
+
+
+def index_size(index):
+    # Serialized size in MB, streamed so the index is never copied. Process
+    # RSS would also count the sample and every index built before this one
+    size = 0
+
+    def count(buffer):
+        nonlocal size
+        size += len(buffer)
+        return len(buffer)
+
+    faiss.write_index(index, faiss.PyCallbackIOWriter(count))
+    return size >> 20
+
+
+if __name__ == "__main__":
+    if not DB_PATH:
+        print("Set DB_PATH to path of hn-sqlite.db")
+        exit()
+
+    num_base = get_opt("sample", 200000)
+    num_queries = get_opt("queries", 500)
+    index_types = get_opt("types", INDEX_TYPES, str)
+    nlists = get_opt("nlist", [search.Index.NLIST])
+    nprobes = get_opt("nprobe", [search.Index.NPROBE])
+    # 0 is a full-dimension index, anything else a Matryoshka coarse pass
+    coarse_dims = get_opt("dims", [0])
+    metric = get_opt("metric", search.Index.METRIC, str)
+    top_k = get_opt("k", search.Index.TOP_K)
+    output = get_opt("out", "benchmark.tsv", str)
+
+    prefix = os.path.splitext(os.path.expanduser(DB_PATH))[0]
+    embed_conn = sqlite3.connect(f"file:{prefix}_embeddings.db?mode=ro", uri=True)
+    vector_store = store.VectorStore(embed_conn, f"{prefix}_embeddings.store")
+    embeddings, item_ids, queries = load_sample(vector_store, num_base, num_queries)
+    queries = np.vstack([load_cached_queries(), queries])
+    truth = ground_truth(embeddings, item_ids, queries, top_k)
+    log_with_mem(f"exact ground truth for {len(queries)} queries over {len(item_ids)}")
+
+    rows = []
+    for index_type in index_types:
+        ivf = "IVF" in search.Index.INDEX_TYPES[index_type]
+        for coarse_dim, nlist in itertools.product(
+            coarse_dims, nlists if ivf else [None]
+        ):
+            start = time.time()
+            index = search.Index.create_index(
+                index_type,
+                embeddings,
+                item_ids,
+                nlist or search.Index.NLIST,
+                coarse_dim,
+                metric,
+            )
+            build_time = time.time() - start
+            index_mb = index_size(index)
+
+            for nprobe in nprobes if ivf else [None]:
+                search.Index.configure_index(index, nprobe)
+                if coarse_dim or index_type in search.Index.RERANKED_TYPES:
+                    wrapped = Reranked(index, coarse_dim, embeddings, item_ids, metric)
+                    r = measure(wrapped, queries, truth, top_k)
+                else:
+                    r = measure(index, queries, truth, top_k)
+                rows.append(
+                    (index_type, coarse_dim or None, nlist, nprobe, build_time)
+                    + (index_mb, r["qps"], r["p50"], r["p99"], r["recall"])
+                )
+                log(
+                    f"benchmarked {index_type} dims={coarse_dim} nlist={nlist} "
+                    f"nprobe={nprobe}"
+                )
+            index, wrapped = None, None
+            gc.collect()
+
+    header = ("index", "dims", "nlist", "nprobe", "build(s)", "size(MB)", "qps")
+    header += ("p50(ms)", "p99(ms)", f"recall@{top_k}")
+    print("\n" + " ".join(f"{h:>10}" for h in header))
+    for row in rows:
+        index_type, coarse_dim, nlist, nprobe, build_time, index_mb = row[:6]
+        qps, p50, p99, recall = row[6:]
+        print(
+            f"{index_type:>10} {coarse_dim or '-':>10} {nlist or '-':>10} "
+            f"{nprobe or '-':>10} {build_time:10.1f} {index_mb:10} {qps:10.1f} "
+            f"{p50:10.2f} {p99:10.2f} {recall:10.4f}"
+        )
+    with open(output, "w") as f:
+        f.write("\t".join(header) + "\n")
+        for row in rows:
+            f.write("\t".join("" if v is None else str(v) for v in row) + "\n")
+    log(f"wrote results to {output}")
+    embed_conn.close()
@@ -1,53 +1,433 @@
 import os
 import json
+import time
+import asyncio
+import hashlib
+import threading
 import collections
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from utils import log
-from openai import OpenAI, OpenAIError
 
-client = OpenAI()
 MAX_CACHE_SIZE = 100000
-CACHE_FILE = "embedder_cache.jsonl"
+MAX_BATCH_SIZE = 2048
+# Misses arriving within this many seconds share one embeddings request
+BATCH_WINDOW = 0.005
+EMBEDDING_DIM = 1536
+# float16 would halve the cache again, at some cost in search precision
+CACHE_DTYPE = np.float32
 
 
-class Embedder:
+class EmbeddingCache:
+    # One row per query in a preallocated slab, 6KB per entry instead of a
+    # 40KB list of Python floats. Untouched rows are never paged in
+    COPY_ROWS = 1024
+
+    def __init__(self, capacity=MAX_CACHE_SIZE, dim=EMBEDDING_DIM, dtype=CACHE_DTYPE):
+        self.slab = np.zeros((capacity, dim), dtype=dtype)
+        # Handed out views are read-only, and stay valid until their slot is
+        # evicted, at least capacity insertions later
+        self.rows = self.slab.view()
+        self.rows.flags.writeable = False
+        self.slots = collections.OrderedDict()
+        # Held while slots are assigned and written, so compactions reading
+        # the slab from their own thread see each row with its query
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, query):
+        return query in self.slots
+
+    def get(self, query):
+        slot = self.slots.get(query)
+        if slot is None:
+            return None
+        self.slots.move_to_end(query)
+        return self.rows[slot]
+
+    def put(self, query, embedding):
+        with self.lock:
+            slot = self.slots.get(query)
+            if slot is None:
+                if len(self.slots) < len(self.slab):
+                    slot = len(self.slots)
+                else:
+                    _, slot = self.slots.popitem(last=False)
+                self.slots[query] = slot
+            self.slots.move_to_end(query)
+            self.slab[slot] = embedding
+        return self.rows[slot]
+
+    def snapshot(self):
+        # Least recently used first, rows are only copied by copy_rows()
+        return list(self.slots.items())
+
+    def copy_rows(self, entries):
+        # Yields the queries and vectors of a snapshot a chunk at a time,
+        # never holding the lock or a copy for more than COPY_ROWS rows
+        for start in range(0, len(entries), self.COPY_ROWS):
+            with self.lock:
+                # Queries evicted since the snapshot lost their slots
+                live = [
+                    (query, slot)
+                    for query, slot in entries[start : start + self.COPY_ROWS]
+                    if self.slots.get(query) == slot
+                ]
+                vectors = self.slab[[slot for _, slot in live]]
+            yield [query for query, _ in live], vectors
+
+
+class CacheStore:
+    # Append-only, row-aligned files: float32 vectors and one normalized
+    # query per line, mapped on startup instead of parsing JSON floats
+    COMPACT_RATIO = 2
+
+    def __init__(self, path, dim=EMBEDDING_DIM):
+        self.path = path
+        self.dim = dim
+        self.count = 0
+        self.vectors_file, self.queries_file = None, None
+        # Compactions write new files in the background, appends carry on
+        # into the old ones and are copied over when the new ones are swapped in
+        self.compactor = ThreadPoolExecutor(1, thread_name_prefix="compact")
+        self.compaction, self.compacted_from = None, None
+
+        self.vectors_path = os.path.join(path, "vectors.f32")
+        self.queries_path = os.path.join(path, "queries.txt")
+        self.meta_path = os.path.join(path, "meta.json")
+
+    def __len__(self):
+        return self.count
+
+    def load(self):
+        os.makedirs(self.path, exist_ok=True)
+        meta = self.read_meta()
+        queries = []
+        if meta and not meta["dirty"] and meta["dim"] == self.dim:
+            if os.path.exists(self.queries_path):
+                with open(self.queries_path, "rb") as f:
+                    # A partial last line has no newline and is dropped
+                    queries = f.read().split(b"\n")[:-1]
+            rows = 0
+            if os.path.exists(self.vectors_path):
+                rows = os.path.getsize(self.vectors_path) // (self.dim * 4)
+            self.count = min(len(queries), rows)
+        else:
+            self.count = 0
+            self.write_meta(dirty=False)
+
+        # Appends interrupted between the two files leave one of them ahead
+        queries = queries[: self.count]
+        with open(self.vectors_path, "ab") as f:
+            f.truncate(self.count * self.dim * 4)
+        with open(self.queries_path, "ab") as f:
+            f.truncate(sum(len(query) + 1 for query in queries))
+
+        if self.count == 0:
+            return [], np.empty((0, self.dim), dtype=np.float32)
+        vectors = np.memmap(
+            self.vectors_path, dtype=np.float32, mode="r", shape=(self.count, self.dim)
+        )
+        return [query.decode("utf-8") for query in queries], vectors
+
+    def append(self, query, embedding):
+        if self.compaction is not None and self.compaction.done():
+            self.swap_compacted()
+        if self.vectors_file is None:
+            self.vectors_file = open(self.vectors_path, "ab")
+            self.queries_file = open(self.queries_path, "ab")
+        # The query line commits the row, so its vector is written first
+        self.vectors_file.write(np.asarray(embedding, dtype=np.float32).tobytes())
+        self.vectors_file.flush()
+        self.queries_file.write(query.encode("utf-8") + b"\n")
+        self.queries_file.flush()
+        self.count += 1
+
+    def rewrite(self, chunks):
+        # Evicted and repeated queries pile up in the files, keep only the
+        # (queries, vectors) chunks given, which are read in the background.
+        # Appends flush every row so the current sizes mark the rows to copy
+        # over on swap
+        self.compacted_from = self.count, [
+            os.path.getsize(path) if os.path.exists(path) else 0
+            for path in (self.vectors_path, self.queries_path)
+        ]
+        self.compaction = self.compactor.submit(self.write_compacted, chunks)
+
+    def write_compacted(self, chunks):
+        count = 0
+        with open(f"{self.vectors_path}.tmp", "wb") as vectors_file, open(
+            f"{self.queries_path}.tmp", "wb"
+        ) as queries_file:
+            for queries, vectors in chunks:
+                vectors_file.write(np.asarray(vectors, dtype=np.float32).tobytes())
+                queries_file.write(
+                    b"".join(query.encode("utf-8") + b"\n" for query in queries)
+                )
+                count += len(queries)
+        return count
+
+    def swap_compacted(self):
+        compaction, self.compaction = self.compaction, None
+        try:
+            count = compaction.result()
+        except OSError as e:
+            log(f"query cache compaction failed: {e}")
+            return
+
+        # Copy over the rows appended while the new files were written
+        rows, sizes = self.compacted_from
+        self.close()
+        self.write_meta(dirty=True)
+        for path, size in zip((self.vectors_path, self.queries_path), sizes):
+            with open(path, "rb") as old_file, open(f"{path}.tmp", "ab") as new_file:
+                old_file.seek(size)
+                new_file.write(old_file.read())
+            os.replace(f"{path}.tmp", path)
+        self.write_meta(dirty=False)
+        self.count += count - rows
+        log(f"compacted query cache to {self.count} entries")
+
+    def read_meta(self):
+        if not os.path.exists(self.meta_path):
+            return None
+        with open(self.meta_path, "r") as f:
+            return json.load(f)
+
+    def write_meta(self, dirty):
+        tmp_path = f"{self.meta_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"dim": self.dim, "dirty": dirty}, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def close(self):
+        if self.vectors_file is not None:
+            self.vectors_file.close()
+            self.queries_file.close()
+            self.vectors_file, self.queries_file = None, None
+
+
+class EmbeddingError(Exception):
+    pass
+
+
+class OpenAIBackend:
+    MODEL = "text-embedding-3-small"
+    # Cached embeddings only make sense for the backend that produced them
+    cache_name = "embedder_cache"
+
     def __init__(self):
-        self.cache = collections.OrderedDict()
+        import openai
+
+        self.errors = openai.OpenAIError
+        self.client = openai.OpenAI()
+        self.async_client = openai.AsyncOpenAI()
+
+    def embed(self, texts):
+        try:
+            response = self.client.embeddings.create(input=texts, model=self.MODEL)
+        except self.errors as e:
+            raise EmbeddingError(f"OpenAI Error: {e}") from e
+        return self.unpack(response)
+
+    async def embed_async(self, texts):
+        try:
+            response = await self.async_client.embeddings.create(
+                input=texts, model=self.MODEL
+            )
+        except self.errors as e:
+            raise EmbeddingError(f"OpenAI Error: {e}") from e
+        return self.unpack(response)
+
+    def unpack(self, response):
+        embeddings = [None] * len(response.data)
+        for data in response.data:
+            embeddings[data.index] = data.embedding
+        return embeddings
+
+
+class HashBackend:
+    # Deterministic offline stand-in: words and character n-grams are hashed
+    # into a sparse random projection, so texts sharing them embed nearby.
+    # Scores against OpenAI document embeddings are meaningless
+    NGRAM = 3
+    NONZEROS = 8
+    cache_name = "embedder_cache_hash"
+
+    def __init__(self, dim=EMBEDDING_DIM):
+        self.dim = dim
+
+    def embed(self, texts):
+        return [self.embed_text(text) for text in texts]
+
+    async def embed_async(self, texts):
+        return self.embed(texts)
+
+    def embed_text(self, text):
+        text = f" {' '.join(text.lower().split())} "
+        features = text.split() + [
+            text[i : i + self.NGRAM] for i in range(len(text) - self.NGRAM + 1)
+        ]
+        hashes = np.frombuffer(
+            b"".join(
+                hashlib.blake2b(
+                    feature.encode("utf-8"), digest_size=4 * self.NONZEROS
+                ).digest()
+                for feature in features
+            ),
+            dtype=np.uint32,
+        )
+        # The top bit picks the sign, the rest the dimension
+        vector = np.zeros(self.dim, dtype=np.float32)
+        np.add.at(
+            vector,
+            (hashes & 0x7FFFFFFF) % self.dim,
+            np.where(hashes >> 31, -1.0, 1.0).astype(np.float32),
+        )
+        return vector / max(np.linalg.norm(vector), 1e-12)
+
+
+class DelayedBackend:
+    # Adds the round trip of a remote API, for load tests without one
+    def __init__(self, backend, latency):
+        self.backend = backend
+        self.latency = latency
+        self.cache_name = backend.cache_name
+
+    def embed(self, texts):
+        time.sleep(self.latency)
+        return self.backend.embed(texts)
+
+    async def embed_async(self, texts):
+        await asyncio.sleep(self.latency)
+        return await self.backend.embed_async(texts)
+
+
+BACKENDS = {"openai": OpenAIBackend, "hash": HashBackend}
+
+
+def create_backend(name="openai", latency=0):
+    if name not in BACKENDS:
+        raise ValueError(
+            f"unknown embedder '{name}', expected one of {', '.join(BACKENDS)}"
+        )
+    backend = BACKENDS[name]()
+    return DelayedBackend(backend, latency) if latency else backend
+
+
+class Embedder:
+    def __init__(self, backend=None, persist=True):
+        self.backend = backend or OpenAIBackend()
+        self.cache = EmbeddingCache()
+        self.cache_file = f"{self.backend.cache_name}.jsonl"
+        self.cache_store = (
+            CacheStore(f"{self.backend.cache_name}.store") if persist else None
+        )
         self.cache_hits = 0
+        # Query -> future for misses queued or being embedded, shared by
+        # every caller asking for the same query meanwhile
+        self.inflight = {}
+        self.queued = []
+        self.flush_timer = None
+        self.requests = set()
         self.load_cache()
 
     def load_cache(self):
-        if os.path.exists(CACHE_FILE):
-            with open(CACHE_FILE, "r", encoding="utf-8") as f:
+        if os.path.exists(self.cache_file):
+            with open(self.cache_file, "r", encoding="utf-8") as f:
                 for line in f:
                     line = line.strip()
                     if line:
                         record = json.loads(line)
-                        self.cache[record["query"]] = record["embedding"]
-            log(f"Loaded {len(self.cache)} cache entries from {CACHE_FILE}.")
+                        self.cache.put(record["query"], record["embedding"])
+            log(f"Loaded {len(self.cache)} cache entries from {self.cache_file}.")
+
+        # Queries embedded before the last restart, the newest copy of each
+        if self.cache_store is not None:
+            queries, vectors = self.cache_store.load()
+            latest = {query: row for row, query in enumerate(queries)}
+            rows = sorted(latest.values())[-len(self.cache.slab) :]
+            for row in rows:
+                self.cache.put(queries[row], vectors[row])
+            log(f"Loaded {len(rows)} cache entries from {self.cache_store.path}.")
 
-    def encode(self, query):
-        # Normalize
-        query = " ".join(query.lower().split())
+    def normalize(self, query):
+        return " ".join(query.lower().split())
 
-        # Check cache
-        if query in self.cache:
+    def lookup(self, query):
+        cached = self.cache.get(query)
+        if cached is not None:
             self.cache_hits += 1
-            self.cache.move_to_end(query)
-            return self.cache[query]
+        return cached
 
-        # Perform request
-        try:
-            response = client.embeddings.create(
-                input=query, model="text-embedding-3-small"
+    def remember(self, query, embeddings):
+        embedding = self.cache.put(query, embeddings)
+        if self.cache_store is not None:
+            self.cache_store.append(query, embedding)
+            if self.cache_store.compaction is None and len(
+                self.cache_store
+            ) > CacheStore.COMPACT_RATIO * len(self.cache):
+                self.cache_store.rewrite(self.cache.copy_rows(self.cache.snapshot()))
+        return embedding
+
+    async def encode_async(self, query):
+        query = self.normalize(query)
+        cached = self.lookup(query)
+        if cached is not None:
+            return cached
+        return await asyncio.shield(self.request(query))
+
+    async def encode_batch_async(self, queries):
+        queries = [self.normalize(query) for query in queries]
+        results = [self.lookup(query) for query in queries]
+        missing = list(dict.fromkeys(q for q, r in zip(queries, results) if r is None))
+        embedded = await asyncio.gather(
+            *[asyncio.shield(self.request(query)) for query in missing]
+        )
+        embedded = dict(zip(missing, embedded))
+        return [
+            embedded.get(query) if result is None else result
+            for query, result in zip(queries, results)
+        ]
+
+    def request(self, query):
+        future = self.inflight.get(query)
+        if future is not None:
+            return future
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[query] = future
+        self.queued.append(query)
+        if len(self.queued) >= MAX_BATCH_SIZE:
+            self.flush()
+        elif self.flush_timer is None:
+            self.flush_timer = asyncio.get_running_loop().call_later(
+                BATCH_WINDOW, self.flush
             )
-            embeddings = response.data[0].embedding
-
-            # Store in cache
-            self.cache[query] = embeddings
-            self.cache.move_to_end(query)
-            if len(self.cache) > MAX_CACHE_SIZE:
-                self.cache.popitem(last=False)
-            return embeddings
-        except OpenAIError as e:
-            print(f"OpenAI Error: {e}")
-            return None
+        return future
+
+    def flush(self):
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        batch, self.queued = self.queued, []
+        if batch:
+            task = asyncio.ensure_future(self.embed_batch(batch))
+            self.requests.add(task)
+            task.add_done_callback(self.requests.discard)
+
+    async def embed_batch(self, batch):
+        try:
+            embeddings = await self.backend.embed_async(batch)
+            for query, embedding in zip(batch, embeddings):
+                embedding = self.remember(query, embedding)
+                self.inflight.pop(query).set_result(embedding)
+        except EmbeddingError as e:
+            print(e)
+        finally:
+            # Callers of failed queries get None
+            for query in batch:
+                future = self.inflight.pop(query, None)
+                if future is not None:
+                    future.set_result(None)
@@ -1,9 +1,12 @@
 import re
 import os
+import copy
 import json
 import html
+import regex
 import sqlite3
 import datetime
+import multiprocessing
 import tiktoken
 
 from collections import defaultdict, deque
@@ -11,6 +14,50 @@ from tqdm import tqdm
 
 
 TIKTOKEN_ENC = tiktoken.get_encoding("cl100k_base")
+# tiktoken splits text into pieces with this pattern, then BPE-encodes each
+TIKTOKEN_PIECES = regex.compile(TIKTOKEN_ENC._pat_str)
+
+
+def token_len(s):
+    return len(TIKTOKEN_ENC.encode(s, disallowed_special=()))
+
+
+class DocumentTokens:
+    # Exact token count of a growing document without re-encoding all of it.
+    # Pieces that end before the trailing whitespace never change when text
+    # is appended, so only the tail from the last word on is encoded again
+    def __init__(self, text=""):
+        self.stable = 0
+        self.tail = ""
+        self.last = None
+        self.append(text)
+
+    def count_with(self, text):
+        tail_tokens = token_len(self.tail + text)
+        self.last = (text, tail_tokens)
+        return self.stable + tail_tokens
+
+    def append(self, text):
+        tail = self.tail + text
+        if self.last and self.last[0] == text:
+            tail_tokens = self.last[1]
+        else:
+            tail_tokens = token_len(tail)
+
+        # Start of the piece holding the last non-whitespace character
+        # A piece always ends at the last line break before that character
+        last = regex.search(r"(?r)\S", tail)
+        end = last.end() if last else 0
+        line = regex.search(r"(?r)[\r\n]", tail, endpos=end)
+        start = line.end() if line else 0
+        for piece in TIKTOKEN_PIECES.finditer(tail, start):
+            if piece.start() >= end:
+                break
+            start = piece.start()
+
+        self.tail = tail[start:]
+        self.stable += tail_tokens - token_len(self.tail)
+        self.last = None
 
 
 class DocumentEmbedder:
@@ -25,8 +72,8 @@ class DocumentEmbedder:
     def get_story_documents(self, constraint):
         story_batch = []
         story_iter = self.story_generator(constraint)
-        for story, comments in story_iter:
-            document_parts = self.create_documents_bfs(story, comments)
+        for story, comments_by_parent in story_iter:
+            document_parts = self.create_documents_bfs(story, comments_by_parent)
             for part_index, document_part in enumerate(document_parts):
                 story_batch.append((story["id"], part_index, document_part))
         return story_batch
@@ -41,8 +88,8 @@ class DocumentEmbedder:
         row = cursor.fetchone()
         while row:
             story = dict(row)
-            comments = self.fetch_comment_data(story["id"])
-            yield story, comments
+            comments_by_parent = self.fetch_comment_data(story["id"])
+            yield story, comments_by_parent
             row = cursor.fetchone()
         cursor.close()
 
@@ -55,33 +102,51 @@ class DocumentEmbedder:
         ]
         return filtered_comments
 
-    def fetch_comments(self, parent_id):
+    def ensure_parent_index(self):
+        # Each level of the comment tree is looked up by parent
         cursor = self.db_conn.cursor()
         cursor.execute(
             """
-            SELECT id, title, text, parent
-            FROM items
-            WHERE type = 'comment' AND parent = ? AND text IS NOT NULL
-            """,
-            (parent_id,),
+            SELECT 1 FROM sqlite_master m, pragma_index_info(m.name) i
+            WHERE m.type = 'index' AND m.tbl_name = 'items'
+            AND i.seqno = 0 AND i.name = 'parent'
+            """
         )
-        return cursor.fetchall()
+        if cursor.fetchone() is None:
+            print("Indexing items by parent, this only happens once...")
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS items_parent_idx ON items(parent)"
+            )
+            self.db_conn.commit()
+        cursor.close()
 
     def fetch_comment_data(self, story_id):
-        top_level_comments = self.fetch_comments(story_id)
-        all_comments = []
-
-        def fetch_descendants(parent_comment):
-            child_comments = self.fetch_comments(parent_comment["id"])
-            for child_comment in child_comments:
-                all_comments.append(child_comment)
-                fetch_descendants(child_comment)
-
-        for top_level_comment in top_level_comments:
-            all_comments.append(top_level_comment)
-            fetch_descendants(top_level_comment)
+        # The whole comment tree in one query, children of comments without
+        # text are unreachable as before
+        cursor = self.db_conn.cursor()
+        cursor.execute(
+            """
+            WITH RECURSIVE tree(id, title, text, parent) AS (
+                SELECT id, title, text, parent
+                FROM items
+                WHERE type = 'comment' AND parent = ? AND text IS NOT NULL
+                UNION ALL
+                SELECT i.id, i.title, i.text, i.parent
+                FROM items i JOIN tree t ON i.parent = t.id
+                WHERE i.type = 'comment' AND i.text IS NOT NULL
+            )
+            SELECT id, title, text, parent FROM tree ORDER BY id
+            """,
+            (story_id,),
+        )
+        comments = self.filter_comments(cursor.fetchall())
+        cursor.close()
 
-        return self.filter_comments(all_comments)
+        # Siblings stay in ID order, as the per-parent queries returned them
+        comments_by_parent = defaultdict(list)
+        for comment in comments:
+            comments_by_parent[comment["parent"]].append(comment)
+        return comments_by_parent
 
     def clean_text(self, text):
         if text is None:
@@ -102,17 +167,12 @@ class DocumentEmbedder:
             header += f'{self.clean_text(story["text"])}\n'
         return header + "Discussion:\n"
 
-    def create_documents_bfs(self, story, comments):
+    def create_documents_bfs(self, story, comments_by_parent):
         document_parts = []
         header = self.story_header(story)
         if header is None:
             return []
 
-        # Build a mapping from parent id to child comments.
-        comments_by_parent = defaultdict(list)
-        for comment in comments:
-            comments_by_parent[comment["parent"]].append(comment)
-
         # Given a top-level comment, produce its breadth-first group.
         def bfs_group(top_comment):
             group = []  # list of (level, text)
@@ -129,19 +189,19 @@ class DocumentEmbedder:
         def format_line(level, text):
             return ("\t" * level) + text + "\n"
 
-        # Helper: get token length of a string.
-        def token_len(s):
-            return len(TIKTOKEN_ENC.encode(s, disallowed_special=()))
-
+        # Running token counts, each line is encoded about once
+        header_tokens = DocumentTokens(header)
         current_document = header
+        current_tokens = copy.copy(header_tokens)
 
         # Process each top-level comment (its parent is the story id)
         for top_comment in comments_by_parent.get(story["id"], []):
             group = bfs_group(top_comment)
             # First, try to append the entire group if it fits.
             group_text = "".join(format_line(level, text) for level, text in group)
-            if token_len(current_document + group_text) <= self.TOKEN_LIMIT:
+            if current_tokens.count_with(group_text) <= self.TOKEN_LIMIT:
                 current_document += group_text
+                current_tokens.append(group_text)
                 continue
 
             # Otherwise, we must add the group piece‐by‐piece.
@@ -150,12 +210,13 @@ class DocumentEmbedder:
                 line_level, line_text = group[i]
                 line = format_line(line_level, line_text)
                 # If adding this line would exceed the token limit…
-                if token_len(current_document + line) > self.TOKEN_LIMIT:
+                if current_tokens.count_with(line) > self.TOKEN_LIMIT:
                     # Flush current document (if it already has some comment lines)
                     if current_document != header:
                         document_parts.append(current_document)
                     # Start a new document part with the header.
                     current_document = header
+                    current_tokens = copy.copy(header_tokens)
                     # In a new document part the first line must be top‑level.
                     # If the line we want to add is not top‑level, re‑emit the group’s top‑level comment
                     # (which is group[0]) and then “rebase” the current line so that it is only one level deep.
@@ -163,28 +224,70 @@ class DocumentEmbedder:
                         # Add the top‑level comment.
                         top_line = format_line(0, group[0][1])
                         # Only add it if it fits.
-                        if token_len(current_document + top_line) <= self.TOKEN_LIMIT:
+                        if current_tokens.count_with(top_line) <= self.TOKEN_LIMIT:
                             current_document += top_line
+                            current_tokens.append(top_line)
                         # Rebase the current line to level 1.
                         line = format_line(1, line_text)
                     # (Now the current_document has a top‑level comment; try adding the line again.)
-                    if token_len(current_document + line) > self.TOKEN_LIMIT:
+                    if current_tokens.count_with(line) > self.TOKEN_LIMIT:
                         # If it still doesn’t fit (e.g. the comment is huge) then we simply skip it.
                         i += 1
                         continue
                     else:
                         current_document += line
+                        current_tokens.append(line)
                         i += 1
                 else:
                     # It fits; add the line and move on.
                     current_document += line
+                    current_tokens.append(line)
                     i += 1
 
         document_parts.append(current_document)
         return document_parts
 
+    def get_batch_records(self, story_ids):
+        # Serialized batch API requests for these stories, in order
+        records = []
+        for story_id in story_ids:
+            story_docs = self.get_story_documents(f"FROM items WHERE id = {story_id}")
+            for story_id, part_index, document_text in story_docs:
+                record = {
+                    "custom_id": f"{story_id}-{part_index}",
+                    "tokens": token_len(document_text),
+                    "method": "POST",
+                    "url": "/v1/embeddings",
+                    "body": {"model": "text-embedding-3-small", "input": document_text},
+                }
+                records.append((record["tokens"], json.dumps(record) + "\n"))
+        return records
+
+
+worker_embedder = None
+
+
+def init_worker(db_path):
+    # Every worker process reads through its own connection
+    global worker_embedder
+    db_conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    db_conn.row_factory = sqlite3.Row
+    worker_embedder = DocumentEmbedder(db_conn)
+
+
+def get_batch_records(story_ids):
+    return worker_embedder.get_batch_records(story_ids)
+
+
+def save_checkpoint(path, checkpoint):
+    # Replaced atomically, a crash leaves the previous checkpoint
+    with open(f"{path}.tmp", "w") as file:
+        json.dump(checkpoint, file)
+    os.replace(f"{path}.tmp", path)
+
 
 DB_PATH = os.getenv("DB_PATH")
+OPTS = os.getenv("OPTS")
 if __name__ == "__main__":
     if not DB_PATH:
         print("Set DB_PATH to path of hn-sqlite.db")
@@ -194,6 +297,7 @@ if __name__ == "__main__":
     db_conn = sqlite3.connect(db_path)
     db_conn.row_factory = sqlite3.Row
     doc_embedder = DocumentEmbedder(db_conn)
+    doc_embedder.ensure_parent_index()
 
     # Get total number of stories to process
     constraint = "FROM items WHERE type = 'story' AND score >= 20 AND descendants >= 3"
@@ -207,36 +311,62 @@ if __name__ == "__main__":
     # Configuration limits.
     MAX_LINES = 50000
     MAX_FILE_SIZE = 190 * 1024 * 1024  # 190 MB in bytes
-    file_index = 1
-    lines_written = 0
-    current_file_size = 0
+    STORIES_PER_TASK = 64
+    workers = (
+        int(re.search(r"workers=(\d+)", OPTS).group(1))
+        if OPTS and "workers=" in OPTS
+        else os.cpu_count()
+    )
+    CHECKPOINT_PATH = "batch_manifest.json"
+
+    # Progress is checkpointed after every task, resume continues from there
+    checkpoint = {
+        "story_id": 0,
+        "file_index": 1,
+        "lines_written": 0,
+        "file_size": 0,
+        "total_tokens": 0,
+    }
+    if OPTS and "resume" in OPTS and os.path.exists(CHECKPOINT_PATH):
+        with open(CHECKPOINT_PATH, "r") as file:
+            checkpoint = json.load(file)
+        print(f"Resuming after story {checkpoint['story_id']}...")
+    file_index = checkpoint["file_index"]
+    lines_written = checkpoint["lines_written"]
+    current_file_size = checkpoint["file_size"]
+    total_tokens = checkpoint["total_tokens"]
     output_file_name = f"batch_{file_index}.jsonl"
-    batch_file = open(output_file_name, "w", encoding="utf-8")
-
-    # Get IDs of stories to process
+    if checkpoint["story_id"]:
+        # Drop requests written after the checkpoint, they are generated again
+        if os.path.exists(output_file_name):
+            os.truncate(output_file_name, current_file_size)
+        batch_file = open(output_file_name, "a", encoding="utf-8")
+    else:
+        batch_file = open(output_file_name, "w", encoding="utf-8")
+
+    # Get IDs of stories to process, workers take consecutive runs of them
     cursor = db_conn.cursor()
-    cursor.execute(f"SELECT id {constraint}")
-    total_tokens = 0
-    while True:
-        row = cursor.fetchone()
-        if not row:
-            break
-
-        story_docs = doc_embedder.get_story_documents(f"FROM items WHERE id = {row[0]}")
-        story_progress.update()
-        for story_id, part_index, document_text in story_docs:
-            cur_tokens = len(TIKTOKEN_ENC.encode(document_text, disallowed_special=()))
+    cursor.execute(
+        f"SELECT id {constraint} AND id > ? ORDER BY id", (checkpoint["story_id"],)
+    )
+    story_ids = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    story_progress.update(total_stories - len(story_ids))
+    tasks = [
+        story_ids[i : i + STORIES_PER_TASK]
+        for i in range(0, len(story_ids), STORIES_PER_TASK)
+    ]
+
+    # Spawned workers load their own tiktoken encoder instead of inheriting
+    # this process's open database connection
+    pool = multiprocessing.get_context("spawn").Pool(
+        workers, initializer=init_worker, initargs=(db_path,)
+    )
+    # Results come back in task order, so files are written as before
+    for task, records in zip(tasks, pool.imap(get_batch_records, tasks)):
+        story_progress.update(len(task))
+        for cur_tokens, record_line in records:
             total_tokens += cur_tokens
-            record = {
-                "custom_id": f"{story_id}-{part_index}",
-                "tokens": cur_tokens,
-                "method": "POST",
-                "url": "/v1/embeddings",
-                "body": {"model": "text-embedding-3-small", "input": document_text},
-            }
-
-            # Serialize record to a JSON string (with a newline).
-            record_line = json.dumps(record) + "\n"
             # Compute the byte size of the record.
             record_line_size = len(record_line.encode("utf-8"))
 
@@ -257,6 +387,19 @@ if __name__ == "__main__":
             lines_written += 1
             current_file_size += record_line_size
 
+        batch_file.flush()
+        os.fsync(batch_file.fileno())
+        checkpoint = {
+            "story_id": task[-1],
+            "file_index": file_index,
+            "lines_written": lines_written,
+            "file_size": current_file_size,
+            "total_tokens": total_tokens,
+        }
+        save_checkpoint(CHECKPOINT_PATH, checkpoint)
+
+    pool.close()
+    pool.join()
     print(f"Total tokens: {total_tokens}")
     story_progress.close()
-    cursor.close()
+    batch_file.close()
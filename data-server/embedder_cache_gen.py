@@ -1,7 +1,10 @@
+import os
+import re
 import json
-from openai import OpenAI
 
-client = OpenAI()
+import embedder
+
+OPTS = os.getenv("OPTS")
 
 EXAMPLE_QUESTIONS = [
     "best laptop for coding that isn't from apple",
@@ -16,18 +19,22 @@ EXAMPLE_QUESTIONS = [
     "effective strategies for overcoming procrastination",
 ]
 
-CACHE_FILE = "embedder_cache.jsonl"
+backend = embedder.create_backend(
+    re.search(r"embedder=(\w+)", OPTS).group(1)
+    if OPTS and "embedder=" in OPTS
+    else "openai"
+)
+CACHE_FILE = f"{backend.cache_name}.jsonl"
 
 with open(CACHE_FILE, "w", encoding="utf-8") as f:
     for query in EXAMPLE_QUESTIONS:
         # Normalize the query
         normalized_query = " ".join(query.lower().split())
 
-        # Call the OpenAI embedding API
-        response = client.embeddings.create(input=query, model="text-embedding-3-small")
-        embeddings = response.data[0].embedding
+        # Call the embedding backend
+        embeddings = backend.embed([query])[0]
 
         # Write the query and its embedding as a JSON object to the file
-        record = {"query": normalized_query, "embedding": embeddings}
+        record = {"query": normalized_query, "embedding": list(map(float, embeddings))}
         f.write(json.dumps(record) + "\n")
         print(f"Cached embedding for query: '{normalized_query}'")
@@ -0,0 +1,249 @@
+import os
+import sys
+import glob
+import json
+import base64
+import sqlite3
+import numpy as np
+
+import store
+import search
+from utils import log, log_with_mem, LogPhase
+
+
+class BatchIngester:
+    EMBEDDING_DIM = 1536
+    TRANSACTION_SIZE = 10000
+
+    def __init__(self, embed_conn):
+        self.embed_conn = embed_conn
+        # Stories whose rows from earlier embedding runs were already dropped
+        self.replaced_stories = set()
+        # Highest part in the results for each story, failed ones included
+        self.last_parts = {}
+        self.inserted = 0
+        self.removed = 0
+        self.unchanged = 0
+        self.failed = 0
+        self.next_id = 1
+
+    def ensure_tables(self):
+        cursor = self.embed_conn.cursor()
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                id INTEGER PRIMARY KEY,
+                story INTEGER,
+                embedding BLOB
+            )
+            """
+        )
+        # The embeddings row holding each part of a story, keyed like custom_id
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS batch_parts (
+                story INTEGER,
+                part INTEGER,
+                id INTEGER,
+                PRIMARY KEY (story, part)
+            ) WITHOUT ROWID
+            """
+        )
+        cursor.execute(
+            """
+            SELECT 1 FROM sqlite_master m, pragma_index_info(m.name) i
+            WHERE m.type = 'index' AND m.tbl_name = 'embeddings'
+            AND i.seqno = 0 AND i.name = 'story'
+            """
+        )
+        if cursor.fetchone() is None:
+            log("indexing embeddings by story, this only happens once...")
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_story_idx ON embeddings(story)"
+            )
+        self.embed_conn.commit()
+
+        # IDs are assigned here so they keep increasing even when the last
+        # rows are replaced, the index replays everything past its max_id
+        cursor.execute("SELECT MAX(id) FROM embeddings")
+        self.next_id = (cursor.fetchone()[0] or 0) + 1
+        cursor.close()
+
+    def parse_result(self, line):
+        # Returns story, part and the float32 blob, which is None for failed
+        # requests
+        result = json.loads(line)
+        story, part = map(int, result["custom_id"].split("-"))
+        response = result.get("response") or {}
+        if response.get("status_code") != 200:
+            return story, part, None
+        embedding = response["body"]["data"][0]["embedding"]
+        if isinstance(embedding, str):
+            vector = np.frombuffer(base64.b64decode(embedding), dtype=np.float32)
+        else:
+            vector = np.asarray(embedding, dtype=np.float32)
+        if len(vector) != self.EMBEDDING_DIM:
+            return story, part, None
+        return story, part, vector.tobytes()
+
+    def ingest_file(self, path):
+        rows = {}
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                story, part, blob = self.parse_result(line)
+                self.last_parts[story] = max(self.last_parts.get(story, part), part)
+                if blob is None:
+                    log(f"no embedding for {story}-{part}, skipping")
+                    self.failed += 1
+                    continue
+                # A part repeated within a transaction keeps its last result
+                rows[(story, part)] = blob
+                if len(rows) >= self.TRANSACTION_SIZE:
+                    self.write_rows(rows)
+                    rows = {}
+        if rows:
+            self.write_rows(rows)
+
+    def write_rows(self, rows):
+        cursor = self.embed_conn.cursor()
+        inserts = []
+        for (story, part), blob in rows.items():
+            if story not in self.replaced_stories:
+                # Rows not written by an ingest come from an older embedding
+                # of the story, which these results replace
+                cursor.execute(
+                    """
+                    DELETE FROM embeddings WHERE story = ?
+                    AND id NOT IN (SELECT id FROM batch_parts WHERE story = ?)
+                    """,
+                    (story, story),
+                )
+                self.replaced_stories.add(story)
+
+            # Re-runs leave identical parts alone, so the index skips them
+            cursor.execute(
+                """
+                SELECT e.id, e.embedding FROM batch_parts p
+                JOIN embeddings e ON e.id = p.id
+                WHERE p.story = ? AND p.part = ?
+                """,
+                (story, part),
+            )
+            existing = cursor.fetchone()
+            if existing and existing[1] == blob:
+                self.unchanged += 1
+                continue
+            if existing:
+                cursor.execute("DELETE FROM embeddings WHERE id = ?", (existing[0],))
+            inserts.append((self.next_id, story, part, blob))
+            self.next_id += 1
+
+        cursor.executemany(
+            "INSERT INTO embeddings (id, story, embedding) VALUES (?, ?, ?)",
+            [(row_id, story, blob) for row_id, story, _, blob in inserts],
+        )
+        cursor.executemany(
+            "INSERT OR REPLACE INTO batch_parts (story, part, id) VALUES (?, ?, ?)",
+            [(story, part, row_id) for row_id, story, part, _ in inserts],
+        )
+        self.embed_conn.commit()
+        cursor.close()
+        self.inserted += len(inserts)
+
+    def remove_stale_parts(self):
+        # Parts past the last one in the results are left over from a longer
+        # embedding of the story. Its remaining parts get new IDs, so the
+        # index replays the story without them
+        cursor = self.embed_conn.cursor()
+        for story, last_part in self.last_parts.items():
+            cursor.execute(
+                "SELECT id FROM batch_parts WHERE story = ? AND part > ?",
+                (story, last_part),
+            )
+            stale = [row[0] for row in cursor.fetchall()]
+            if not stale:
+                continue
+            cursor.executemany(
+                "DELETE FROM embeddings WHERE id = ?", [(row_id,) for row_id in stale]
+            )
+            cursor.execute(
+                "DELETE FROM batch_parts WHERE story = ? AND part > ?",
+                (story, last_part),
+            )
+            cursor.execute(
+                "SELECT part, id FROM batch_parts WHERE story = ? ORDER BY part",
+                (story,),
+            )
+            for part, row_id in cursor.fetchall():
+                cursor.execute(
+                    "UPDATE embeddings SET id = ? WHERE id = ?", (self.next_id, row_id)
+                )
+                cursor.execute(
+                    "UPDATE batch_parts SET id = ? WHERE story = ? AND part = ?",
+                    (self.next_id, story, part),
+                )
+                self.next_id += 1
+            self.removed += len(stale)
+        self.embed_conn.commit()
+        cursor.close()
+
+    def update_indexes(self, prefix):
+        # Replays the new stories into every persisted index, as the data
+        # server would on its next start
+        vector_store = store.VectorStore(self.embed_conn, f"{prefix}_embeddings.store")
+        if os.path.exists(vector_store.meta_path):
+            vector_store.sync()
+        for index_path in sorted(glob.glob(f"{glob.escape(prefix)}_embeddings*.faiss")):
+            meta_path = f"{index_path}.json"
+            if not os.path.exists(meta_path):
+                continue
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            index_type = meta.get("index_type", "ivfflat")
+            if index_type in search.Index.READ_ONLY_TYPES:
+                log(f"{index_type} index {index_path} is rebuilt on the next start")
+                continue
+
+            lp = LogPhase(f"updated {index_path}")
+            index = search.Index(
+                self.embed_conn,
+                None,
+                index_path,
+                store=vector_store,
+                index_type=index_type,
+                nlist=meta.get("nlist", search.Index.NLIST),
+                workers=1,
+                story_range=meta.get("story_range"),
+                coarse_dim=meta.get("coarse_dim"),
+                metric=meta.get("metric", search.Index.METRIC),
+            )
+            index.executor.shutdown()
+            index.rebuild_executor.shutdown()
+            lp.stop()
+
+
+DB_PATH = os.getenv("DB_PATH")
+if __name__ == "__main__":
+    if not DB_PATH or len(sys.argv) < 2:
+        print("Usage: DB_PATH=hn-sqlite.db python embedder_ingest.py results.jsonl...")
+        exit()
+
+    prefix = os.path.splitext(os.path.expanduser(DB_PATH))[0]
+    embed_conn = sqlite3.connect(f"{prefix}_embeddings.db")
+    ingester = BatchIngester(embed_conn)
+    ingester.ensure_tables()
+
+    for path in sys.argv[1:]:
+        lp = LogPhase(f"ingested {path}")
+        ingester.ingest_file(path)
+        lp.stop()
+    ingester.remove_stale_parts()
+    log_with_mem(
+        f"{ingester.inserted} embeddings written, {ingester.unchanged} unchanged, "
+        f"{ingester.removed} removed, {ingester.failed} failed"
+    )
+
+    ingester.update_indexes(prefix)
+    embed_conn.close()
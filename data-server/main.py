@@ -4,11 +4,15 @@ import uvicorn
 import asyncio
 import sqlite3
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
 from fastapi.responses import HTMLResponse
-from typing import Optional
+from pydantic import BaseModel
+from typing import List, Optional
 
+import store
+import shard
 import search
+import metadata
 import updater
 import embedder
 from utils import log, print_db_stats, LogPhase, Telemetry
@@ -23,13 +27,83 @@ encoder, sync_service, search_index = None, None, None
 
 
 @app.get("/search")
-async def search_api(query: str, top_k: Optional[int] = search.Index.TOP_K):
-    return await search_index.search(query, top_k=top_k)
+async def search_api(
+    response: Response,
+    query: str,
+    top_k: Optional[int] = search.Index.TOP_K,
+    aggregate: Optional[search.Aggregate] = None,
+    by: Optional[str] = None,
+    before_time: Optional[int] = None,
+    after_time: Optional[int] = None,
+    min_score: Optional[int] = None,
+    max_score: Optional[int] = None,
+    min_comments: Optional[int] = None,
+    max_comments: Optional[int] = None,
+):
+    filters = {
+        "by": by,
+        "before_time": before_time,
+        "after_time": after_time,
+        "min_score": min_score,
+        "max_score": max_score,
+        "min_comments": min_comments,
+        "max_comments": max_comments,
+    }
+    filters = {key: value for key, value in filters.items() if value}
+    # Lets clients tell distances (lower is better) from similarities
+    response.headers["X-Search-Metric"] = search_index.metric
+    return await search_index.search(
+        query, top_k=top_k, aggregate=aggregate, filters=filters
+    )
+
+
+class SearchBatchRequest(BaseModel):
+    queries: List[str]
+    top_k: Optional[int] = search.Index.TOP_K
+    aggregate: Optional[search.Aggregate] = None
+    by: Optional[str] = None
+    before_time: Optional[int] = None
+    after_time: Optional[int] = None
+    min_score: Optional[int] = None
+    max_score: Optional[int] = None
+    min_comments: Optional[int] = None
+    max_comments: Optional[int] = None
+
+
+@app.post("/search_batch")
+async def search_batch_api(request: SearchBatchRequest, response: Response):
+    filters = request.dict(exclude={"queries", "top_k", "aggregate"})
+    filters = {key: value for key, value in filters.items() if value}
+    response.headers["X-Search-Metric"] = search_index.metric
+    return await search_index.search_batch(
+        request.queries,
+        top_k=request.top_k,
+        aggregate=request.aggregate,
+        filters=filters,
+    )
+
+
+@app.post("/rebuild")
+async def rebuild_api():
+    return await search_index.rebuild()
+
+
+@app.get("/metrics")
+async def metrics_api():
+    return await search_index.metrics()
 
 
 @app.get("/health", response_class=HTMLResponse)
 async def health_api(update_db: Optional[bool] = False):
     report = telemetry.report(update_db=update_db)
+    index_report = await search_index.metrics()
+    list_sizes = index_report.pop("list_sizes", None)
+    if list_sizes:
+        index_report["list_sizes"] = (
+            f"{min(list_sizes)} / {sorted(list_sizes)[len(list_sizes) // 2]} / {max(list_sizes)} "
+            "(min / median / max)"
+        )
+    index_report.pop("shards", None)
     with open(os.path.join(os.path.dirname(__file__), "health.html"), "r") as file:
         html_template = file.read()
 
@@ -64,25 +138,93 @@ async def health_api(update_db: Optional[bool] = False):
                 for key, value in report["flags"].items()
             ]
         ),
+        index_metrics="".join(
+            [
+                f"<tr><td>{key}</td><td>{value}</td></tr>"
+                for key, value in index_report.items()
+            ]
+        ),
     )
 
     return HTMLResponse(content=html_content, status_code=200)
 
 
-async def main(db_conn, embed_conn):
+async def main(db_conn, embed_conn, prefix):
     global encoder, doc_embedder, sync_service, search_index
 
     # Parse options if available
     dosync = False if OPTS and "nosync" in OPTS else True
+    reindex = True if OPTS and "reindex" in OPTS else False
     offset = (
         int(re.search(r"offset=(\d+)", OPTS).group(1))
         if OPTS and "offset=" in OPTS
         else 1000
     )
+    index_type = (
+        re.search(r"index=(\w+)", OPTS).group(1)
+        if OPTS and "index=" in OPTS
+        else os.getenv("INDEX_TYPE", search.Index.INDEX_TYPE)
+    )
+    nlist = (
+        int(re.search(r"nlist=(\d+)", OPTS).group(1))
+        if OPTS and "nlist=" in OPTS
+        else search.Index.NLIST
+    )
+    nprobe = (
+        int(re.search(r"nprobe=(\d+)", OPTS).group(1))
+        if OPTS and "nprobe=" in OPTS
+        else search.Index.NPROBE
+    )
+    workers = (
+        int(re.search(r"workers=(\d+)", OPTS).group(1))
+        if OPTS and "workers=" in OPTS
+        else search.Index.WORKERS
+    )
+    metric = (
+        re.search(r"metric=(\w+)", OPTS).group(1)
+        if OPTS and "metric=" in OPTS
+        else search.Index.METRIC
+    )
+    coarse_dim = (
+        int(re.search(r"dims=(\d+)", OPTS).group(1))
+        if OPTS and "dims=" in OPTS
+        else None
+    )
+    shards = (
+        int(re.search(r"shards=(\d+)", OPTS).group(1))
+        if OPTS and "shards=" in OPTS
+        else 0
+    )
+    shard_urls = os.getenv("SHARDS")
+    retrain = (
+        float(re.search(r"retrain=([\d.]+)", OPTS).group(1))
+        if OPTS and "retrain=" in OPTS
+        else 0
+    )
+    max_drift = (
+        float(re.search(r"drift=([\d.]+)", OPTS).group(1))
+        if OPTS and "drift=" in OPTS
+        else 0
+    )
+    max_imbalance = (
+        float(re.search(r"imbalance=([\d.]+)", OPTS).group(1))
+        if OPTS and "imbalance=" in OPTS
+        else 0
+    )
+    backend = (
+        re.search(r"embedder=(\w+)", OPTS).group(1)
+        if OPTS and "embedder=" in OPTS
+        else "openai"
+    )
+    latency = (
+        float(re.search(r"latency=([\d.]+)", OPTS).group(1))
+        if OPTS and "latency=" in OPTS
+        else 0
+    )
 
-    # Load embedder
+    # Load embedder, latency simulates a remote API for offline load tests
     lp = LogPhase("loaded embedder")
-    encoder = embedder.Embedder()
+    encoder = embedder.Embedder(embedder.create_backend(backend, latency / 1000))
     lp.stop()
 
     # Start sync service
@@ -97,12 +239,60 @@ async def main(db_conn, embed_conn):
     updates = await sync_service.run()
     lp.stop()
 
-    # Load vector search
-    lp = LogPhase("loaded vector search index")
-    log("creating vector index...")
-    search_index = search.Index(embed_conn, encoder)
-    sync_service.search_index = search_index
-    lp.stop()
+    if shard_urls or shards:
+        # Shards host the index and story metadata, this process fans out
+        lp = LogPhase("connected to search shards")
+        if shard_urls:
+            search_index = shard.ShardedIndex(
+                encoder, shard_urls.split(","), metric=metric
+            )
+        else:
+            log(f"starting {shards} search shards...")
+            search_index = shard.ShardedIndex.spawn(
+                encoder, embed_conn, prefix, shards, OPTS, metric
+            )
+        await search_index.wait_ready()
+        sync_service.story_metadata = search_index.story_metadata
+        sync_service.search_index = search_index
+        lp.stop()
+    else:
+        # Load story metadata for filtered search
+        lp = LogPhase("loaded story metadata")
+        story_metadata = metadata.StoryMetadata(db_conn)
+        sync_service.story_metadata = story_metadata
+        lp.stop()
+
+        # Load vector search
+        lp = LogPhase("loaded vector search index")
+        log("creating vector index...")
+        search_index = search.Index(
+            embed_conn,
+            encoder,
+            f"{prefix}_embeddings.faiss",
+            store=store.VectorStore(embed_conn, f"{prefix}_embeddings.store"),
+            metadata=story_metadata,
+            index_type=index_type,
+            nlist=nlist,
+            nprobe=nprobe,
+            workers=workers,
+            coarse_dim=coarse_dim,
+            metric=metric,
+            rebuild=reindex,
+        )
+        sync_service.search_index = search_index
+        lp.stop()
+
+    # Retrain on fresh embeddings every few hours, swapping the index live
+    rebuilds = []
+    if retrain:
+        rebuilds.append(
+            asyncio.create_task(search_index.rebuild_periodically(retrain * 3600))
+        )
+    # Or as soon as live updates have unbalanced the lists
+    if max_drift or max_imbalance:
+        rebuilds.append(
+            asyncio.create_task(search_index.retrain_on_drift(max_drift, max_imbalance))
+        )
 
     # Start API server
     telemetry.connect(db_conn, embed_conn, sync_service, encoder)
@@ -121,7 +311,12 @@ async def main(db_conn, embed_conn):
         await uvicorn_task
 
     print("Exiting...")
+    for task in rebuilds:
+        task.cancel()
     await sync_service.shutdown()
+    if search_index.dirty:
+        search_index.save_index()
+    await search_index.close()
     db_conn.close()
     embed_conn.close()
 
@@ -136,8 +331,11 @@ if __name__ == "__main__":
     db_conn.row_factory = sqlite3.Row
 
     prefix = os.path.splitext(db_path)[0]
-    embed_conn = sqlite3.connect(f"file:{prefix}_embeddings.db?mode=ro", uri=True)
+    # Exact filtered searches read embeddings from the search thread pool
+    embed_conn = sqlite3.connect(
+        f"file:{prefix}_embeddings.db?mode=ro", uri=True, check_same_thread=False
+    )
     embed_conn.row_factory = sqlite3.Row
 
     print_db_stats(db_conn, embed_conn)
-    asyncio.run(main(db_conn, embed_conn))
+    asyncio.run(main(db_conn, embed_conn, prefix))
@@ -0,0 +1,163 @@
+import numpy as np
+
+from utils import log_with_mem
+
+
+class StoryMetadata:
+    CHUNK_SIZE = 65536
+    COLUMNS = {
+        "ids": np.int64,
+        "time": np.int64,
+        "score": np.int32,
+        "descendants": np.int32,
+        "by": np.int32,
+    }
+
+    def __init__(self, db_conn, story_range=None):
+        self.db_conn = db_conn
+        # Shards only track the stories in their [start, end) range
+        self.story_range = story_range
+        self.authors = {}
+        self.size = 0
+        self.columns = {}
+        # filter() runs on search threads while update() runs on the event
+        # loop, so readers take the size and columns from this one tuple
+        self.view = (0, {})
+        # Bumped on every update, cached filtered searches check it
+        self.generation = 0
+        self.load()
+
+    def __len__(self):
+        return self.view[0]
+
+    def load(self):
+        constraint, params = "", ()
+        if self.story_range:
+            start, end = self.story_range
+            constraint, params = " AND id >= ?", (start,)
+            if end is not None:
+                constraint, params = constraint + " AND id < ?", params + (end,)
+
+        cursor = self.db_conn.cursor()
+        cursor.execute(
+            f"SELECT COUNT(*) FROM items WHERE type = 'story'{constraint}", params
+        )
+        self.allocate(cursor.fetchone()[0])
+
+        cursor.execute(
+            f"""
+            SELECT id, time, score, descendants, by
+            FROM items WHERE type = 'story'{constraint} ORDER BY id
+            """,
+            params,
+        )
+        while True:
+            rows = cursor.fetchmany(self.CHUNK_SIZE)
+            if not rows:
+                break
+            self.append(rows)
+        cursor.close()
+        self.view = (self.size, self.columns)
+        log_with_mem(f"loaded metadata for {self.size} stories")
+
+    def allocate(self, capacity, order=None):
+        # New arrays, optionally reordered, the published ones stay intact
+        columns = {}
+        for name, dtype in self.COLUMNS.items():
+            column = np.zeros(max(capacity, 1024), dtype=dtype)
+            if name in self.columns:
+                rows = self.columns[name][: self.size]
+                column[: self.size] = rows if order is None else rows[order]
+            columns[name] = column
+        self.columns = columns
+
+    def append(self, rows):
+        if self.size + len(rows) > len(self.columns["ids"]):
+            self.allocate(2 * (self.size + len(rows)))
+        end = self.size + len(rows)
+        ids, times, scores, descendants, authors = zip(*rows)
+        self.columns["ids"][self.size : end] = ids
+        self.columns["time"][self.size : end] = [t or 0 for t in times]
+        self.columns["score"][self.size : end] = [s or 0 for s in scores]
+        self.columns["descendants"][self.size : end] = [d or 0 for d in descendants]
+        self.columns["by"][self.size : end] = [self.intern(a) for a in authors]
+        self.size = end
+
+    def intern(self, author):
+        if author is None:
+            return -1
+        return self.authors.setdefault(author, len(self.authors))
+
+    def in_range(self, story_id):
+        if not self.story_range:
+            return True
+        start, end = self.story_range
+        return story_id >= start and (end is None or story_id < end)
+
+    def update(self, items):
+        # Items arrive from the HN firebase API, only stories are tracked
+        rows = sorted(
+            {
+                item["id"]: (
+                    item["id"],
+                    item.get("time"),
+                    item.get("score"),
+                    item.get("descendants"),
+                    item.get("by"),
+                )
+                for item in items
+                if item and item.get("type") == "story" and self.in_range(item["id"])
+            }.values()
+        )
+        ids = self.columns["ids"][: self.size]
+        new_rows = []
+        for row in rows:
+            pos = np.searchsorted(ids, row[0])
+            if pos < self.size and ids[pos] == row[0]:
+                self.columns["time"][pos] = row[1] or 0
+                self.columns["score"][pos] = row[2] or 0
+                self.columns["descendants"][pos] = row[3] or 0
+                self.columns["by"][pos] = self.intern(row[4])
+            elif pos == self.size:
+                new_rows.append(row)
+            else:
+                # Out of order story, rare enough to rebuild the columns
+                self.append([row])
+                order = np.argsort(self.columns["ids"][: self.size], kind="stable")
+                self.allocate(len(self.columns["ids"]), order)
+                ids = self.columns["ids"][: self.size]
+        if new_rows:
+            self.append(new_rows)
+        if rows:
+            # Appended rows were past the published size until now
+            self.view = (self.size, self.columns)
+            self.generation += 1
+
+    def filter(
+        self,
+        by=None,
+        before_time=None,
+        after_time=None,
+        min_score=None,
+        max_score=None,
+        min_comments=None,
+        max_comments=None,
+    ):
+        size, columns = self.view
+        columns = {name: column[:size] for name, column in columns.items()}
+        mask = np.ones(size, dtype=bool)
+        if by:
+            mask &= columns["by"] == self.authors.get(by, -2)
+        if before_time:
+            mask &= columns["time"] <= before_time
+        if after_time:
+            mask &= columns["time"] >= after_time
+        if min_score:
+            mask &= columns["score"] >= min_score
+        if max_score:
+            mask &= columns["score"] <= max_score
+        if min_comments:
+            mask &= columns["descendants"] >= min_comments
+        if max_comments:
+            mask &= columns["descendants"] <= max_comments
+        return columns["ids"][mask]
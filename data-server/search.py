@@ -1,67 +1,973 @@
 import gc
+import os
+import asyncio
+import collections
+import glob
+import json
+import time
+import threading
+import contextlib
 import numpy as np
 import faiss
 
-from utils import log_with_mem
+from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
+import store
+from utils import log, log_with_mem
+
+
+class Aggregate(str, Enum):
+    min = "min"
+    softmax = "softmax"
+
+
+class ResultCache:
+    # LRU of search results, each tagged with the index generation it was
+    # computed on so updates invalidate exactly the entries they affect
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, generation):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] != generation:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, generation, results):
+        self.entries[key] = (generation, results)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+
+class SharedLock:
+    # Searches share the live index, updates that mutate it in place wait
+    # for them to finish and hold back new ones until done
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writers = 0
+        self.writing = False
+
+    @contextlib.contextmanager
+    def shared(self):
+        with self.condition:
+            self.condition.wait_for(lambda: not self.writers)
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        with self.condition:
+            self.writers += 1
+            self.condition.wait_for(lambda: not self.readers and not self.writing)
+            self.writing = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writers -= 1
+                self.writing = False
+                self.condition.notify_all()
+
+
+class IDMapSearch:
+    # faiss 1.7.4 IndexIDMap2 takes no search parameters, so filtered
+    # searches go to the wrapped index, selecting by its internal row IDs
+    def __init__(self, index, id_map):
+        # Holding the IDMap2 index keeps the wrapped one alive across swaps
+        self.index = index
+        self.wrapped = faiss.downcast_index(index.index)
+        self.id_map = id_map
+        self.ntotal = index.ntotal
+        self.metric_type = index.metric_type
+
+    def search(self, x, k, params=None):
+        D, I = self.wrapped.search(x, k, params=params)
+        return D, np.where(I >= 0, self.id_map[I], -1)
 
 
 class Index:
     TOP_K = 50
     NLIST = 100
     NPROBE = 35
+    EF_SEARCH = 128
     EMBEDDING_DIM = 1536
+    MAX_TRAIN_POINTS = 256
+    MAX_TRAIN_SIZE = 1 << 19
+    ADD_BATCH_SIZE = 65536
+    OVERFETCH = 4
+    SOFTMIN_TEMPERATURE = 0.05
+    EXACT_SEARCH_STORIES = 2000
+    RERANK_CANDIDATES = 400
+    DRIFT_CHECK_INTERVAL = 600
+    RESULT_CACHE_SIZE = 10000
+    WORKERS = os.cpu_count() or 1
 
-    def __init__(self, embed_conn, encoder):
+    # faiss index_factory strings, see README for memory per vector
+    INDEX_TYPE = "ivfflat"
+    INDEX_TYPES = {
+        "ivfflat": "IVF{nlist},Flat",
+        "ivfsq8": "IVF{nlist},SQ8",
+        "ivfpq": "IVF{nlist},PQ64",
+        "ivfpqr": "IVF{nlist},PQ64",
+        "opq": "OPQ64,IVF{nlist},PQ64",
+        "hnsw": "IDMap2,HNSW32,Flat",
+        "ivfhnsw": "IVF{nlist}_HNSW32,Flat",
+    }
+    # Index types whose candidates are refined with the full vectors in the
+    # store, faiss 1.7.4 can only refine indexes without custom IDs
+    RERANKED_TYPES = {"ivfpqr"}
+    # Index types whose faiss implementation has no remove_ids, or whose
+    # refinement would miss the vectors added since the store was mapped
+    READ_ONLY_TYPES = {"ivfpqr", "hnsw"}
+    # OpenAI embeddings are unit length, so inner product is cosine similarity
+    METRIC = "l2"
+    METRICS = {"l2": faiss.METRIC_L2, "cosine": faiss.METRIC_INNER_PRODUCT}
+
+    def __init__(
+        self,
+        embed_conn,
+        encoder,
+        index_path=None,
+        store=None,
+        metadata=None,
+        index_type=INDEX_TYPE,
+        nlist=NLIST,
+        nprobe=NPROBE,
+        workers=WORKERS,
+        story_range=None,
+        coarse_dim=None,
+        metric=METRIC,
+        rebuild=False,
+    ):
+        if index_type not in self.INDEX_TYPES:
+            raise ValueError(
+                f"unknown index type '{index_type}', "
+                f"expected one of {', '.join(self.INDEX_TYPES)}"
+            )
+        if metric not in self.METRICS:
+            raise ValueError(
+                f"unknown metric '{metric}', expected one of {', '.join(self.METRICS)}"
+            )
+        if (coarse_dim or index_type in self.RERANKED_TYPES) and not store:
+            raise ValueError(f"{index_type} index needs a vector store to rerank from")
         self.encoder = encoder
         self.embed_conn = embed_conn
+        self.index_path = index_path
+        self.store = store
+        self.metadata = metadata
+        self.index_type = index_type
+        self.nlist = nlist
+        self.nprobe = nprobe
+        # Half-open [start, end) of story IDs hosted by a shard, end may be None
+        self.story_range = tuple(story_range) if story_range else None
+        # Matryoshka mode: the index holds truncated vectors and candidates
+        # are reranked with the full vectors in the store
+        self.coarse_dim = coarse_dim
+        # Scores are reported in metric, which may differ from the metric a
+        # persisted index was built with
+        self.metric = metric
+        self.max_id = 0
+        self.dirty = False
+        self.rerank = None
+        # The IDMap2 index and its ID map, for filtered searches
+        self.id_map = None
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="search")
+        self.search_slots = asyncio.Semaphore(workers)
+        # Held by searches, and exclusively by updates to the live index
+        self.index_lock = SharedLock()
+        # Rebuilds train on their own thread and never block searches
+        self.rebuild_executor = ThreadPoolExecutor(1, thread_name_prefix="rebuild")
+        self.rebuild_task = None
+        # Bumped whenever the vectors searched change
+        self.generation = 0
+        self.results = ResultCache(self.RESULT_CACHE_SIZE)
+        # Live updates land in centroids trained on older embeddings, these
+        # describe the index as it was when last trained
+        self.trained_vectors = 0
+        self.trained_imbalance = None
+        self.added_vectors = 0
 
-        embeddings, item_ids = self.load_embeddings()
-        self.index = faiss.IndexIVFFlat(
-            faiss.IndexFlatL2(self.EMBEDDING_DIM),
-            self.EMBEDDING_DIM,
-            self.NLIST,
-            faiss.METRIC_L2,
-        )
-        log_with_mem("loaded embeddings into memory")
+        if not (index_path and not rebuild and self.load_index()):
+            self.index, self.max_id = self.build_index()
+            self.reset_training_stats()
+            if index_path:
+                self.save_index()
+        if self.reranked():
+            self.rerank = self.load_rerank_vectors()
 
-        self.index.train(embeddings)
-        self.index.nprobe = self.NPROBE
-        log_with_mem("trained index")
+    def build_index(self, compact=True):
+        # Returns a new index and the last embeddings.id it covers, the live
+        # index is left alone so this can run while searches continue
+        rows = None
+        if self.store:
+            # Vectors stay memory-mapped and are streamed into the index
+            self.store.sync(compact=compact)
+            max_id = self.store.max_id
+            embeddings, item_ids = self.store.load()
+            rows = self.store.live_rows()
+            if self.story_range:
+                in_range = np.flatnonzero(self.in_range(item_ids))
+                rows = in_range if rows is None else np.intersect1d(rows, in_range)
+        else:
+            max_id = self.get_max_id()
+            constraint, params = self.story_constraint()
+            embeddings, item_ids = self.load_embeddings(f"WHERE {constraint}", params)
+        log_with_mem("loaded embeddings into memory")
 
-        self.index.add_with_ids(embeddings, item_ids)
-        embeddings = None
+        index = self.create_index(
+            self.index_type,
+            embeddings,
+            item_ids,
+            self.nlist,
+            self.coarse_dim,
+            self.metric,
+            rows,
+        )
+        self.configure_index(index, self.nprobe)
+        embeddings, item_ids = None, None
         gc.collect()
-        log_with_mem("built index with IDs")
+        log_with_mem(f"built {self.index_type} index with IDs")
+        return index, max_id
+
+    @classmethod
+    def create_index(
+        cls,
+        index_type,
+        embeddings,
+        item_ids,
+        nlist=NLIST,
+        coarse_dim=None,
+        metric=METRIC,
+        rows=None,
+    ):
+        # rows optionally picks the vectors to index without copying the rest
+        index = faiss.index_factory(
+            coarse_dim or cls.EMBEDDING_DIM,
+            cls.INDEX_TYPES[index_type].format(nlist=nlist),
+            cls.METRICS[metric],
+        )
+        if not index.is_trained:
+            index.train(
+                cls.truncate(cls.training_sample(embeddings, nlist, rows), coarse_dim)
+            )
+            log_with_mem(f"trained {index_type} index")
+
+        num_rows = len(item_ids) if rows is None else len(rows)
+        for start in range(0, num_rows, cls.ADD_BATCH_SIZE):
+            end = start + cls.ADD_BATCH_SIZE
+            batch = slice(start, end) if rows is None else rows[start:end]
+            index.add_with_ids(
+                cls.truncate(embeddings[batch], coarse_dim), item_ids[batch]
+            )
+        return index
+
+    @classmethod
+    def truncate(cls, embeddings, coarse_dim=None):
+        # text-embedding-3 vectors stay usable when cut short and renormalized
+        if not coarse_dim:
+            return embeddings
+        embeddings = np.array(embeddings[:, :coarse_dim], dtype=np.float32)
+        embeddings /= np.maximum(
+            np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12
+        )
+        return embeddings
+
+    @classmethod
+    def configure_index(cls, index, nprobe=NPROBE):
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf:
+            ivf.nprobe = nprobe
+        if isinstance(index, faiss.IndexIDMap2):
+            faiss.downcast_index(index.index).hnsw.efSearch = cls.EF_SEARCH
+
+    @classmethod
+    def training_sample(cls, embeddings, nlist=NLIST, rows=None):
+        # k-means only looks at MAX_TRAIN_POINTS per centroid (IVF lists or the
+        # 256 codewords of each PQ sub-quantizer), so copy just those
+        num_train = min(max(nlist, 256) * cls.MAX_TRAIN_POINTS, cls.MAX_TRAIN_SIZE)
+        num_rows = len(embeddings) if rows is None else len(rows)
+        if num_rows <= num_train:
+            if rows is None:
+                return np.ascontiguousarray(embeddings)
+            return embeddings[rows]
+        rng = np.random.default_rng(1234)
+        sample = np.sort(rng.choice(num_rows, num_train, replace=False))
+        return embeddings[sample if rows is None else rows[sample]]
+
+    def load_index(self):
+        meta = self.read_meta()
+        if not meta or meta.get("dirty", True):
+            log("no clean persisted index found, rebuilding")
+            return False
+        if (meta.get("index_type", "ivfflat"), meta.get("nlist", self.NLIST)) != (
+            self.index_type,
+            self.nlist,
+        ):
+            log("persisted index has different type or nlist, rebuilding")
+            return False
+        if meta.get("story_range") != self.story_range_meta():
+            log("persisted index covers different stories, rebuilding")
+            return False
+        if meta.get("coarse_dim") != self.coarse_dim:
+            log("persisted index has different coarse_dim, rebuilding")
+            return False
+
+        # Inverted lists stay in the .ivfdata file and are paged in on demand
+        self.index = faiss.read_index(self.index_path, faiss.IO_FLAG_ONDISK_SAME_DIR)
+        self.configure_index(self.index, self.nprobe)
+        self.max_id = meta["max_id"]
+        self.trained_vectors = meta.get("trained_vectors", self.index.ntotal)
+        self.trained_imbalance = meta.get("trained_imbalance")
+        self.added_vectors = meta.get("added_vectors", 0)
+        log_with_mem(f"mapped persisted index ({self.index.ntotal} vectors)")
+
+        # An l2 index keeps serving cosine scores (and vice versa) until the
+        # next reindex, see to_distances()
+        if self.metric_name(self.index) != self.metric:
+            log(
+                f"serving {self.metric} scores from "
+                f"{self.metric_name(self.index)} index, "
+                "add reindex to OPTS to rebuild it"
+            )
+
+        # Replay stories embedded since the index was written
+        if self.reranked():
+            self.store.sync()
+        max_id = self.get_max_id()
+        constraint, params = self.story_constraint()
+        cursor = self.embed_conn.cursor()
+        cursor.execute(
+            f"SELECT DISTINCT story FROM embeddings WHERE id > ? AND {constraint}",
+            (self.max_id,) + params,
+        )
+        story_ids = [row[0] for row in cursor.fetchall()]
+        cursor.execute(f"SELECT COUNT(*) FROM embeddings WHERE {constraint}", params)
+        num_embeddings = cursor.fetchone()[0]
+        cursor.close()
+
+        if story_ids and not self.supports_updates():
+            log(f"{self.index_type} index cannot replay updates, rebuilding")
+            self.index = None
+            return False
+        if story_ids:
+            self.update_embeddings(story_ids)
+            log_with_mem(f"replayed {len(story_ids)} updated stories")
+        if self.index.ntotal != num_embeddings:
+            log(
+                f"persisted index out of sync ({self.index.ntotal} vs "
+                f"{num_embeddings} embeddings), rebuilding"
+            )
+            self.index = None
+            gc.collect()
+            return False
+
+        self.max_id = max_id
+        if story_ids:
+            self.save_index()
+        return True
+
+    def save_index(self):
+        self.write_index(self.index)
+        self.dirty = False
+        self.write_meta()
+        self.remove_stale_data()
+
+    def write_index(self, index):
+        ivf = faiss.try_extract_index_ivf(index)
+        invlists = faiss.downcast_InvertedLists(ivf.invlists) if ivf else None
+        if ivf and not isinstance(invlists, faiss.OnDiskInvertedLists):
+            # Move freshly built lists into a new data file and release the RAM copy
+            root = os.path.splitext(self.index_path)[0]
+            data_path = f"{root}.{time.time_ns()}.ivfdata"
+            ondisk = faiss.OnDiskInvertedLists(ivf.nlist, invlists.code_size, data_path)
+            for list_no in range(ivf.nlist):
+                list_size = invlists.list_size(list_no)
+                if list_size:
+                    ondisk.add_entries(
+                        list_no,
+                        list_size,
+                        invlists.get_ids(list_no),
+                        invlists.get_codes(list_no),
+                    )
+            ivf.replace_invlists(ondisk, True)
+            ondisk.this.disown()
+            gc.collect()
+
+        tmp_path = f"{self.index_path}.tmp"
+        faiss.write_index(index, tmp_path)
+        os.replace(tmp_path, self.index_path)
+        log_with_mem(f"saved index to {self.index_path}")
+
+    def remove_stale_data(self):
+        # Data files left behind by earlier builds, an index swapped out by a
+        # rebuild keeps its mapping until the last search on it finishes
+        data_file = None
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf:
+            data_file = os.path.basename(
+                faiss.downcast_InvertedLists(ivf.invlists).filename
+            )
+        root = os.path.splitext(self.index_path)[0]
+        for path in glob.glob(f"{glob.escape(root)}.*.ivfdata"):
+            if os.path.basename(path) != data_file:
+                os.remove(path)
+
+    def read_meta(self):
+        meta_path = f"{self.index_path}.json"
+        if not os.path.exists(meta_path) or not os.path.exists(self.index_path):
+            return None
+        with open(meta_path, "r") as f:
+            return json.load(f)
+
+    def write_meta(self):
+        tmp_path = f"{self.index_path}.json.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "max_id": self.max_id,
+                    "ntotal": self.index.ntotal,
+                    "index_type": self.index_type,
+                    "nlist": self.nlist,
+                    "story_range": self.story_range_meta(),
+                    "coarse_dim": self.coarse_dim,
+                    "metric": self.metric_name(self.index),
+                    "trained_vectors": self.trained_vectors,
+                    "trained_imbalance": self.trained_imbalance,
+                    "added_vectors": self.added_vectors,
+                    "dirty": self.dirty,
+                },
+                f,
+            )
+        os.replace(tmp_path, f"{self.index_path}.json")
+
+    def mark_dirty(self):
+        # The data file is modified in place, so a crash before the next
+        # save_index() must not leave a header that looks valid
+        if self.index_path and not self.dirty:
+            self.dirty = True
+            self.write_meta()
+
+    def story_range_meta(self):
+        return list(self.story_range) if self.story_range else None
+
+    def story_constraint(self):
+        if not self.story_range:
+            return "1", ()
+        start, end = self.story_range
+        if end is None:
+            return "story >= ?", (start,)
+        return "story >= ? AND story < ?", (start, end)
+
+    def in_range(self, story_ids):
+        start, end = self.story_range
+        mask = story_ids >= start
+        if end is not None:
+            mask &= story_ids < end
+        return mask
+
+    def load_rerank_vectors(self):
+        # Full vectors stay memory-mapped, only candidate rows are paged in
+        vectors, vector_stories = self.store.load()
+        story_rows = store.StoryRows(vector_stories, self.store.live_rows())
+        log_with_mem(f"mapped {len(vector_stories)} vectors for reranking")
+        return vectors, vector_stories, story_rows
+
+    @classmethod
+    def metric_name(cls, index):
+        if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+            return "cosine"
+        return "l2"
+
+    async def rebuild(self):
+        # Concurrent callers share the rebuild that is already running
+        if self.rebuild_task is None or self.rebuild_task.done():
+            self.rebuild_task = asyncio.ensure_future(self.rebuild_and_swap())
+        return await asyncio.shield(self.rebuild_task)
+
+    async def rebuild_and_swap(self):
+        start = time.time()
+        index, max_id, rerank = await asyncio.get_running_loop().run_in_executor(
+            self.rebuild_executor, self.build_replacement
+        )
+
+        # Searches read self.index once, so in-flight ones finish on the old
+        # index and later ones see the new one
+        old_vectors = self.index.ntotal
+        self.rerank = rerank
+        self.index = index
+        self.max_id = max_id
+        self.generation += 1
+        self.reset_training_stats()
+        if self.index_path:
+            self.dirty = False
+            self.write_meta()
+            self.remove_stale_data()
+        elapsed = time.time() - start
+        log_with_mem(
+            f"swapped in rebuilt index ({old_vectors} -> {index.ntotal} vectors) "
+            f"in {elapsed:.1f}s"
+        )
+        return {"vectors": index.ntotal, "max_id": max_id, "build_time": elapsed}
+
+    def build_replacement(self):
+        # The store is only appended to, compacting it would move rows under
+        # memory-mapped vectors that searches may still be reading
+        index, max_id = self.build_index(compact=False)
+        if self.index_path:
+            self.write_index(index)
+        rerank = self.load_rerank_vectors() if self.reranked() else None
+        return index, max_id, rerank
+
+    async def rebuild_periodically(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.rebuild()
+            except Exception as e:
+                log(f"Retrying rebuild later after exception: {e}")
+
+    async def retrain_on_drift(
+        self, max_drift=None, max_imbalance=None, interval=DRIFT_CHECK_INTERVAL
+    ):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                metrics = await self.metrics()
+                # Sharded indexes report one entry per shard, None if it failed
+                reasons = [
+                    self.drift_reason(shard_metrics, max_drift, max_imbalance)
+                    for shard_metrics in metrics.get("shards", [metrics])
+                    if shard_metrics
+                ]
+                reasons = [reason for reason in reasons if reason]
+                if reasons:
+                    log(f"retraining drifted index: {'; '.join(reasons)}")
+                    await self.rebuild()
+            except Exception as e:
+                log(f"Retrying drift check later after exception: {e}")
+
+    @classmethod
+    def drift_reason(cls, metrics, max_drift=None, max_imbalance=None):
+        # Imbalance is relative to the trained index, k-means never produces
+        # perfectly even lists on real embeddings
+        if max_drift and metrics["drift"] > max_drift:
+            return (
+                f"{metrics['added_since_training']} vectors added since training "
+                f"on {metrics['trained_vectors']}"
+            )
+        imbalance = metrics.get("imbalance")
+        trained_imbalance = metrics.get("trained_imbalance")
+        if (
+            max_imbalance
+            and imbalance
+            and trained_imbalance
+            and imbalance > trained_imbalance * max_imbalance
+        ):
+            return (
+                f"list imbalance grew from {trained_imbalance:.2f} to {imbalance:.2f}"
+            )
+        return None
+
+    async def metrics(self):
+        index = self.index
+        metrics = {
+            "index_type": self.index_type,
+            "vectors": index.ntotal,
+            "trained_vectors": self.trained_vectors,
+            "added_since_training": self.added_vectors,
+            "drift": self.added_vectors / max(self.trained_vectors, 1),
+        }
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf:
+            # Scan cost per probe grows with sum(size^2) over the lists, which
+            # imbalance compares to perfectly even lists. faiss counts scanned
+            # codes process-wide and without locking, so treat it as a sample
+            stats = faiss.cvar.indexIVF_stats
+            metrics.update(
+                {
+                    "nlist": ivf.nlist,
+                    "nprobe": self.nprobe,
+                    "imbalance": self.imbalance_factor(index),
+                    "trained_imbalance": self.trained_imbalance,
+                    "queries": stats.nq,
+                    "codes_per_query": stats.ndis / max(stats.nq, 1),
+                    "list_sizes": [
+                        ivf.invlists.list_size(list_no) for list_no in range(ivf.nlist)
+                    ],
+                }
+            )
+        return metrics
+
+    @classmethod
+    def imbalance_factor(cls, index):
+        ivf = faiss.try_extract_index_ivf(index)
+        if not ivf or not index.ntotal:
+            return None
+        return ivf.invlists.imbalance_factor()
+
+    def reset_training_stats(self):
+        self.trained_vectors = self.index.ntotal
+        self.trained_imbalance = self.imbalance_factor(self.index)
+        self.added_vectors = 0
+        faiss.cvar.indexIVF_stats.reset()
+
+    def reranked(self):
+        return bool(self.coarse_dim) or self.index_type in self.RERANKED_TYPES
+
+    def supports_updates(self):
+        return self.index_type not in self.READ_ONLY_TYPES
+
+    def get_max_id(self):
+        cursor = self.embed_conn.cursor()
+        cursor.execute("SELECT MAX(id) FROM embeddings")
+        max_id = cursor.fetchone()[0] or 0
+        cursor.close()
+        return max_id
 
-    async def search(self, query, top_k=TOP_K):
-        query_embedding = self.encoder.encode(query)
-        if not query_embedding:
+    async def search(self, query, top_k=TOP_K, aggregate=None, filters=None):
+        # Read the generation first, results of a search that overlaps an
+        # update are cached as already stale
+        key = self.cache_key(query, top_k, aggregate, filters)
+        generation = self.cache_generation(filters)
+        cached = self.results.get(key, generation)
+        if cached is not None:
+            return cached
+
+        query_embedding = await self.encoder.encode_async(query)
+        if query_embedding is None:
             return []
-        D, I = self.index.search(np.array([query_embedding], dtype=np.float32), top_k)
+        results = await self.run_search([query_embedding], top_k, aggregate, filters)
+        self.results.put(key, generation, results[0])
+        return results[0]
+
+    async def search_batch(self, queries, top_k=TOP_K, aggregate=None, filters=None):
+        keys = [self.cache_key(query, top_k, aggregate, filters) for query in queries]
+        generation = self.cache_generation(filters)
+        results = [self.results.get(key, generation) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if not missing:
+            return results
+
+        query_embeddings = await self.encoder.encode_batch_async(
+            [queries[i] for i in missing]
+        )
+        found = [
+            i
+            for i, embedding in zip(missing, query_embeddings)
+            if embedding is not None
+        ]
+        for i in missing:
+            results[i] = []
+        if found:
+            found_results = await self.run_search(
+                [embedding for embedding in query_embeddings if embedding is not None],
+                top_k,
+                aggregate,
+                filters,
+            )
+            for i, result in zip(found, found_results):
+                results[i] = result
+                self.results.put(keys[i], generation, result)
+        return results
+
+    def cache_key(self, query, top_k, aggregate, filters):
+        return (
+            self.encoder.normalize(query),
+            top_k,
+            aggregate,
+            tuple(sorted(filters.items())) if filters else (),
+        )
+
+    def cache_generation(self, filters):
+        # Filtered results also depend on story metadata, which the sync
+        # service updates far more often than the vectors
+        if filters and self.metadata is not None:
+            return self.generation, self.metadata.generation
+        return self.generation
+
+    async def run_search(self, query_embeddings, top_k, aggregate, filters):
+        # faiss releases the GIL, so searches run in parallel on the pool
+        async with self.search_slots:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor,
+                self.search_embeddings,
+                query_embeddings,
+                top_k,
+                aggregate,
+                filters,
+            )
+
+    def search_embeddings(self, query_embeddings, top_k, aggregate=None, filters=None):
+        # Ranking always uses distances where lower is better, cosine
+        # similarities are negated and only flipped back for the response
+        results = self.rank_stories(query_embeddings, top_k, aggregate, filters)
+        if self.metric == "cosine":
+            results = [
+                [(story_id, -distance) for story_id, distance in result]
+                for result in results
+            ]
+        return results
+
+    def rank_stories(self, query_embeddings, top_k, aggregate=None, filters=None):
+        with self.index_lock.shared():
+            return self.rank_stories_locked(query_embeddings, top_k, aggregate, filters)
+
+    def rank_stories_locked(self, query_embeddings, top_k, aggregate, filters):
+        query_embeddings = np.array(query_embeddings, dtype=np.float32)
+        # A rebuild may swap self.index at any time, stick to one index
+        index = self.index
+
+        params = None
+        if filters and self.metadata is not None:
+            story_ids = self.metadata.filter(**filters)
+            if len(story_ids) <= self.EXACT_SEARCH_STORIES:
+                return self.search_exact(query_embeddings, story_ids, top_k, aggregate)
+            index, params = self.search_params(index, story_ids, top_k)
+        if self.reranked():
+            return self.search_rerank(index, query_embeddings, top_k, aggregate, params)
+        if aggregate:
+            return self.search_stories(
+                index, query_embeddings, top_k, aggregate, params
+            )
+        D, I = index.search(query_embeddings, top_k, params=params)
+        D = self.to_distances(index, D)
+        return [self.unique_stories(d, i) for d, i in zip(D, I)]
 
+    def to_distances(self, index, D):
+        # Unit vectors have squared L2 distance = 2 - 2 * cosine similarity,
+        # which lets either kind of index serve either metric
+        if self.metric_name(index) == self.metric:
+            return -D if self.metric == "cosine" else D
+        if self.metric == "cosine":
+            return D / 2 - 1
+        return 2 - 2 * D
+
+    def unique_stories(self, distances, chunk_ids):
         unique_story_ids = []
         seen_ids = set()
-        for story_id, distance in zip(I[0], D[0]):
-            if story_id not in seen_ids:
+        for story_id, distance in zip(chunk_ids, distances):
+            if story_id >= 0 and story_id not in seen_ids:
                 seen_ids.add(story_id)
                 unique_story_ids.append((story_id.item(), distance.item()))
         return unique_story_ids
 
+    def search_params(self, index, story_ids, top_k):
+        # Returns the index to search with the parameters, which differs
+        # from the given index for IDMap2 wrappers
+        if isinstance(index, faiss.IndexIDMap2):
+            return self.id_map_search_params(index, story_ids)
+        selector = faiss.IDSelectorBatch(len(story_ids), faiss.swig_ptr(story_ids))
+        ivf = faiss.try_extract_index_ivf(index)
+        if not ivf:
+            return index, faiss.SearchParameters(sel=selector)
+
+        # Probe enough lists that OVERFETCH * top_k matching chunks are
+        # expected, otherwise selective filters starve the results
+        selectivity = len(story_ids) / max(len(self.metadata), 1)
+        matches_per_list = index.ntotal * selectivity / ivf.nlist
+        nprobe = int(np.ceil(top_k * self.OVERFETCH / max(matches_per_list, 1e-6)))
+        return index, faiss.SearchParametersIVF(
+            sel=selector, nprobe=min(ivf.nlist, max(self.nprobe, nprobe))
+        )
+
+    def id_map_search_params(self, index, story_ids):
+        # IDMap2 indexes are read-only, so their ID map is copied once
+        cached = self.id_map
+        if cached is None or cached[0] is not index:
+            cached = self.id_map = (index, faiss.vector_to_array(index.id_map))
+        id_map = cached[1]
+        rows = np.flatnonzero(np.isin(id_map, story_ids)).astype(np.int64)
+        selector = faiss.IDSelectorBatch(len(rows), faiss.swig_ptr(rows))
+        id_map_search = IDMapSearch(index, id_map)
+        if isinstance(id_map_search.wrapped, faiss.IndexHNSW):
+            # HNSW params replace the index's efSearch instead of inheriting it
+            params = faiss.SearchParametersHNSW(
+                sel=selector, efSearch=id_map_search.wrapped.hnsw.efSearch
+            )
+        else:
+            params = faiss.SearchParameters(sel=selector)
+        return id_map_search, params
+
+    def search_exact(self, query_embeddings, story_ids, top_k, aggregate):
+        # Small candidate sets are cheaper to scan directly than to probe for
+        embeddings, chunk_ids = self.load_embeddings(
+            "WHERE story IN (SELECT value FROM json_each(?))",
+            (json.dumps(story_ids.tolist()),),
+        )
+        return [
+            self.rank_chunks(distances, chunk_ids, top_k, aggregate)
+            for distances in self.exact_distances(
+                query_embeddings, embeddings, self.metric
+            )
+        ]
+
+    def search_rerank(self, index, query_embeddings, top_k, aggregate, params=None):
+        # Truncated vectors only pick candidate stories, all of their chunks
+        # are then scored with the full vectors
+        vectors, vector_stories, story_rows = self.rerank
+        fetch = min(max(self.RERANK_CANDIDATES, top_k * self.OVERFETCH), index.ntotal)
+        _, I = index.search(
+            self.truncate(query_embeddings, self.coarse_dim), fetch, params=params
+        )
+        results = []
+        for query_embedding, chunk_ids in zip(query_embeddings, I):
+            rows = story_rows.lookup(np.unique(chunk_ids[chunk_ids >= 0]))
+            distances = self.exact_distances(
+                query_embedding[None], vectors[rows], self.metric
+            )
+            results.append(
+                self.rank_chunks(distances[0], vector_stories[rows], top_k, aggregate)
+            )
+        return results
+
+    @classmethod
+    def exact_distances(cls, query_embeddings, embeddings, metric=METRIC):
+        if metric == "cosine":
+            return -(query_embeddings @ embeddings.T)
+        return (
+            (query_embeddings**2).sum(axis=1, keepdims=True)
+            - 2 * query_embeddings @ embeddings.T
+            + (embeddings**2).sum(axis=1)
+        )
+
+    def rank_chunks(self, distances, chunk_ids, top_k, aggregate):
+        order = np.argsort(distances, kind="stable")
+        distances, chunk_ids = distances[order], chunk_ids[order]
+        if aggregate:
+            story_ids, distances = self.aggregate_stories(
+                distances, chunk_ids, aggregate
+            )
+            return list(zip(story_ids[:top_k].tolist(), distances[:top_k].tolist()))
+        return self.unique_stories(distances[:top_k], chunk_ids[:top_k])
+
+    def search_stories(self, index, query_embeddings, top_k, aggregate, params=None):
+        # Over-fetch chunks until they cover top_k distinct stories, only
+        # re-searching the queries that are still short
+        results = [None] * len(query_embeddings)
+        pending = np.arange(len(query_embeddings))
+        fetch = top_k * self.OVERFETCH
+        while len(pending):
+            fetch = min(fetch, index.ntotal)
+            D, I = index.search(query_embeddings[pending], fetch, params=params)
+            D = self.to_distances(index, D)
+            short = []
+            for row, query in enumerate(pending):
+                story_ids, distances = self.aggregate_stories(D[row], I[row], aggregate)
+                # Missing hits (-1) mean the probed lists are exhausted
+                if len(story_ids) >= top_k or fetch >= index.ntotal or I[row, -1] < 0:
+                    results[query] = list(
+                        zip(story_ids[:top_k].tolist(), distances[:top_k].tolist())
+                    )
+                else:
+                    short.append(query)
+            pending = np.array(short, dtype=np.int64)
+            fetch *= 2
+        return results
+
+    def aggregate_stories(self, distances, chunk_ids, aggregate):
+        found = chunk_ids >= 0
+        distances, chunk_ids = distances[found], chunk_ids[found]
+        if aggregate == Aggregate.min:
+            # Hits are sorted, so a story's first hit is its closest chunk
+            story_ids, first = np.unique(chunk_ids, return_index=True)
+            order = np.argsort(first)
+            return story_ids[order], distances[first[order]]
+
+        # Soft minimum: -T * log(sum(exp(-d / T))) rewards stories with
+        # several close chunks. Exponents are taken relative to each story's
+        # closest chunk so they cannot overflow
+        story_ids, story_index = np.unique(chunk_ids, return_inverse=True)
+        closest = np.full(len(story_ids), np.inf, dtype=distances.dtype)
+        np.minimum.at(closest, story_index, distances)
+        weights = np.exp((closest[story_index] - distances) / self.SOFTMIN_TEMPERATURE)
+        scores = closest - self.SOFTMIN_TEMPERATURE * np.log(
+            np.bincount(story_index, weights=weights)
+        )
+        # Clamped to the best possible distance, 0 for L2 and a similarity of
+        # 1 for cosine, which keeps results in the metric's range and in order
+        scores = np.maximum(scores, -1 if self.metric == "cosine" else 0)
+        order = np.argsort(scores, kind="stable")
+        return story_ids[order], scores[order]
+
     def update_embeddings(self, story_ids):
-        # log_with_mem(f"updating {len(story_ids)} embeddings")
-        for story_id in story_ids:
-            self.index.remove_ids(np.array([story_id], dtype=np.int64))
-            new_embeddings, new_item_ids = self.load_embeddings(
-                f"WHERE story = {story_id}"
+        if not self.supports_updates():
+            log(
+                f"{self.index_type} index is read-only, skipping {len(story_ids)} updates"
             )
-            self.index.add_with_ids(new_embeddings, new_item_ids)
-        # log_with_mem(f"updated faiss index!\n")
+            return None
+
+        # Single pass over the IVF lists, one query and one add for the whole set
+        story_ids = np.unique(np.fromiter(story_ids, dtype=np.int64))
+        if self.story_range:
+            story_ids = story_ids[self.in_range(story_ids)]
+            if not len(story_ids):
+                return None
+        start = time.time()
+        new_embeddings, new_item_ids = self.load_embeddings(
+            "WHERE story IN (SELECT value FROM json_each(?))",
+            (json.dumps(story_ids.tolist()),),
+        )
+        fetch_time = time.time() - start
+
+        # Removal and re-add modify the index in place, searches on the pool
+        # must not see its lists mid-update
+        with self.index_lock.exclusive():
+            self.mark_dirty()
+            start = time.time()
+            removed = self.index.remove_ids(
+                faiss.IDSelectorBatch(len(story_ids), faiss.swig_ptr(story_ids))
+            )
+            remove_time = time.time() - start
+
+            start = time.time()
+            self.index.add_with_ids(
+                self.truncate(new_embeddings, self.coarse_dim), new_item_ids
+            )
+            add_time = time.time() - start
+            self.added_vectors += len(new_item_ids)
+            self.generation += 1
+
+        log(
+            f"updated {len(story_ids)} stories (-{removed} +{len(new_item_ids)} vectors): "
+            f"remove({remove_time:.3f}) fetch({fetch_time:.3f}) add({add_time:.3f})"
+        )
+        return {
+            "stories": len(story_ids),
+            "removed": removed,
+            "added": len(new_item_ids),
+            "remove_time": remove_time,
+            "fetch_time": fetch_time,
+            "add_time": add_time,
+        }
+
+    async def close(self):
+        if self.rebuild_task and not self.rebuild_task.done():
+            await asyncio.wait([self.rebuild_task])
+        self.executor.shutdown()
+        self.rebuild_executor.shutdown()
 
-    def load_embeddings(self, constraint=""):
+    def load_embeddings(self, constraint="", params=()):
         cursor = self.embed_conn.cursor()
 
         # Fetch the total number of embeddings
-        cursor.execute(f"SELECT COUNT(*) FROM embeddings {constraint}")
+        cursor.execute(f"SELECT COUNT(*) FROM embeddings {constraint}", params)
         num_embeddings = cursor.fetchone()[0]
 
         # Create an empty numpy array to hold the embeddings and item IDs
@@ -70,7 +976,7 @@ class Index:
 
         # Fetch all embeddings and their story/item IDs from the database and fill the numpy arrays
         cursor.execute(
-            f"SELECT story, embedding FROM embeddings {constraint} ORDER BY id"
+            f"SELECT story, embedding FROM embeddings {constraint} ORDER BY id", params
         )
         for i, (story_id, embedding) in enumerate(cursor.fetchall()):
             item_ids[i] = story_id
@@ -0,0 +1,435 @@
+import os
+import re
+import sys
+import json
+import heapq
+import base64
+import asyncio
+import sqlite3
+import aiohttp
+import uvicorn
+import subprocess
+import numpy as np
+
+from fastapi import FastAPI
+from pydantic import BaseModel
+from typing import List, Optional
+
+import store
+import search
+import metadata
+from utils import log, LogPhase
+
+OPTS = os.getenv("OPTS")
+DB_PATH = os.getenv("DB_PATH")
+PORT = 8002
+
+app = FastAPI()
+search_index, story_metadata = None, None
+
+
+class SearchRequest(BaseModel):
+    # Base64 of the float32 query matrix, far cheaper to parse than JSON floats
+    embeddings: str
+    top_k: int = search.Index.TOP_K
+    aggregate: Optional[search.Aggregate] = None
+    filters: dict = {}
+
+
+class MetadataRequest(BaseModel):
+    items: List[dict]
+
+
+@app.post("/search_embeddings")
+async def search_embeddings_api(request: SearchRequest):
+    query_embeddings = np.frombuffer(
+        base64.b64decode(request.embeddings), dtype=np.float32
+    ).reshape(-1, search.Index.EMBEDDING_DIM)
+    return await search_index.run_search(
+        query_embeddings, request.top_k, request.aggregate, request.filters
+    )
+
+
+@app.post("/update_metadata")
+async def update_metadata_api(request: MetadataRequest):
+    story_metadata.update(request.items)
+    return {"stories": len(story_metadata)}
+
+
+@app.post("/rebuild")
+async def rebuild_api():
+    return await search_index.rebuild()
+
+
+@app.get("/health")
+async def health_api():
+    return {
+        "metric": search_index.metric,
+        "stories": search_index.story_range_meta(),
+        "vectors": search_index.index.ntotal,
+        "rebuilding": bool(
+            search_index.rebuild_task and not search_index.rebuild_task.done()
+        ),
+    }
+
+
+@app.get("/metrics")
+async def metrics_api():
+    return await search_index.metrics()
+
+
+class ShardedIndex(search.Index):
+    # Coordinator with the same search API as Index, each shard process hosts
+    # the stories in one ID range so merged results never overlap
+    TIMEOUT = 60
+    # A rebuild retrains the whole shard, only connecting to it is bounded
+    REBUILD_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=TIMEOUT)
+    STARTUP_POLL = 5
+
+    def __init__(self, encoder, urls, processes=(), metric=search.Index.METRIC):
+        self.encoder = encoder
+        self.urls = urls
+        self.store = None
+        self.metric = metric
+        self.processes = list(processes)
+        self.dirty = False
+        self.generation = 0
+        self.results = search.ResultCache(self.RESULT_CACHE_SIZE)
+        self.metadata = self.story_metadata = ShardedMetadata(self)
+        self.session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=self.TIMEOUT)
+        )
+        self.pending = set()
+
+    @classmethod
+    def spawn(
+        cls,
+        encoder,
+        embed_conn,
+        prefix,
+        num_shards,
+        opts=None,
+        metric=search.Index.METRIC,
+    ):
+        # Sync the shared vector store once, before shards start reading it
+        vector_store = store.VectorStore(embed_conn, f"{prefix}_embeddings.store")
+        vector_store.sync()
+        ranges = cls.story_ranges(
+            embed_conn, f"{prefix}_embeddings.shards.json", num_shards
+        )
+
+        opts = (opts or "") + ",shared_store"
+        env = dict(os.environ)
+        if "workers=" not in opts:
+            workers = max(1, search.Index.WORKERS // num_shards)
+            opts += f",workers={workers}"
+            env["OMP_NUM_THREADS"] = str(workers)
+        processes, urls = [], []
+        for shard, (start, end) in enumerate(ranges):
+            port = PORT + shard
+            env["OPTS"] = (
+                f"{opts},shard={shard},stories={start}-{'' if end is None else end},"
+                f"port={port}"
+            )
+            processes.append(subprocess.Popen([sys.executable, __file__], env=env))
+            urls.append(f"http://127.0.0.1:{port}")
+        sharded_index = cls(encoder, urls, processes, metric)
+        sharded_index.store = vector_store
+        return sharded_index
+
+    @classmethod
+    def story_ranges(cls, embed_conn, path, num_shards):
+        # Boundaries are persisted so shard indexes survive restarts, the
+        # last shard is open ended and takes all newly embedded stories
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                ranges = json.load(f)
+            if len(ranges) == num_shards:
+                return ranges
+
+        cursor = embed_conn.cursor()
+        cursor.execute(
+            "SELECT story, COUNT(*) FROM embeddings GROUP BY story ORDER BY story"
+        )
+        rows = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 2)
+        cursor.close()
+
+        # Split on cumulative chunk counts so shards hold similar vector counts
+        if len(rows):
+            counts = np.cumsum(rows[:, 1])
+            splits = np.searchsorted(
+                counts, counts[-1] * np.arange(1, num_shards) / num_shards
+            )
+            bounds = [0] + rows[splits, 0].tolist() + [None]
+        else:
+            bounds = [0] * num_shards + [None]
+        ranges = [[bounds[i], bounds[i + 1]] for i in range(num_shards)]
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(ranges, f)
+        os.replace(tmp_path, path)
+        log(f"partitioned stories into {num_shards} shards: {ranges}")
+        return ranges
+
+    async def wait_ready(self):
+        # Shards build or map their indexes in parallel before serving
+        for shard, url in enumerate(self.urls):
+            process = self.processes[shard] if self.processes else None
+            while True:
+                if process and process.poll() is not None:
+                    raise RuntimeError(
+                        f"shard {url} exited with code {process.returncode}"
+                    )
+                try:
+                    async with self.session.get(f"{url}/health") as response:
+                        health = await response.json()
+                        break
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    await asyncio.sleep(self.STARTUP_POLL)
+            if health["metric"] != self.metric:
+                raise RuntimeError(
+                    f"shard {url} serves {health['metric']} scores, "
+                    f"expected {self.metric}"
+                )
+            log(
+                f"shard {url} ready ({health['vectors']} vectors, "
+                f"stories {health['stories']})"
+            )
+
+    async def run_search(self, query_embeddings, top_k, aggregate, filters):
+        payload = {
+            "embeddings": base64.b64encode(
+                np.asarray(query_embeddings, dtype=np.float32).tobytes()
+            ).decode(),
+            "top_k": top_k,
+            "aggregate": aggregate,
+            "filters": filters or {},
+        }
+        shard_results = await asyncio.gather(
+            *[self.post(url, "/search_embeddings", payload) for url in self.urls]
+        )
+
+        # A failed shard only costs its share of the results, which must not
+        # be served from the result cache once it is back
+        if any(results is None for results in shard_results):
+            self.generation += 1
+        shard_results = [results for results in shard_results if results is not None]
+        if not shard_results:
+            return [[] for _ in query_embeddings]
+        return [self.merge(results, top_k) for results in zip(*shard_results)]
+
+    async def rebuild(self):
+        # Local shards read the store that this process keeps in sync
+        if self.store:
+            await asyncio.get_running_loop().run_in_executor(
+                None, lambda: self.store.sync(compact=False)
+            )
+        stats = await asyncio.gather(*[self.rebuild_shard(url) for url in self.urls])
+        # Every shard has now swapped in its new index or given up, bumping
+        # any earlier would tag results from an old index as current
+        self.generation += 1
+        failed = [url for url, result in zip(self.urls, stats) if result is None]
+        if failed:
+            raise RuntimeError(f"rebuild failed on shards {', '.join(failed)}")
+        return stats
+
+    async def rebuild_shard(self, url):
+        stats = await self.post(url, "/rebuild", {}, self.REBUILD_TIMEOUT)
+        # A lost response does not stop the rebuild, which may still swap
+        # later, so wait until the shard is idle or unreachable
+        while stats is None:
+            health = await self.get(url, "/health")
+            if not health or not health.get("rebuilding"):
+                break
+            await asyncio.sleep(self.STARTUP_POLL)
+        return stats
+
+    async def metrics(self):
+        shard_metrics = await asyncio.gather(
+            *[self.get(url, "/metrics") for url in self.urls]
+        )
+        found = [metrics for metrics in shard_metrics if metrics]
+        return {
+            "vectors": sum(metrics["vectors"] for metrics in found),
+            "added_since_training": sum(
+                metrics["added_since_training"] for metrics in found
+            ),
+            "drift": max((metrics["drift"] for metrics in found), default=0),
+            "imbalance": max(
+                (metrics["imbalance"] for metrics in found if metrics.get("imbalance")),
+                default=None,
+            ),
+            "shards": shard_metrics,
+        }
+
+    def merge(self, results, top_k):
+        # Each shard returns its stories sorted by distance or similarity
+        sign = -1 if self.metric == "cosine" else 1
+        merged = heapq.merge(*results, key=lambda result: sign * result[1])
+        return [tuple(result) for _, result in zip(range(top_k), merged)]
+
+    async def post(self, url, path, payload, timeout=None):
+        try:
+            async with self.session.post(
+                f"{url}{path}", json=payload, timeout=timeout or self.session.timeout
+            ) as response:
+                response.raise_for_status()
+                return await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log(f"shard {url} failed on {path}: {e}")
+            return None
+
+    async def get(self, url, path):
+        try:
+            async with self.session.get(f"{url}{path}") as response:
+                response.raise_for_status()
+                return await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log(f"shard {url} failed on {path}: {e}")
+            return None
+
+    def broadcast(self, path, payload):
+        task = asyncio.ensure_future(
+            asyncio.gather(*[self.post(url, path, payload) for url in self.urls])
+        )
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+        return task
+
+    async def close(self):
+        if self.pending:
+            await asyncio.wait(self.pending)
+        await self.session.close()
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.wait()
+
+
+class ShardedMetadata:
+    # Stands in for StoryMetadata in the sync service, shards filter locally
+    def __init__(self, index):
+        self.index = index
+        self.generation = 0
+
+    def update(self, items):
+        stories = [item for item in items if item and item.get("type") == "story"]
+        if stories:
+            # Cached filtered searches stay valid until the shards have it
+            task = self.index.broadcast("/update_metadata", {"items": stories})
+            task.add_done_callback(self.invalidate)
+
+    def invalidate(self, task=None):
+        self.generation += 1
+
+
+async def main(db_conn, embed_conn, prefix):
+    global search_index, story_metadata
+
+    # Parse options if available
+    reindex = True if OPTS and "reindex" in OPTS else False
+    shard = (
+        int(re.search(r"shard=(\d+)", OPTS).group(1))
+        if OPTS and "shard=" in OPTS
+        else 0
+    )
+    story_range = (
+        re.search(r"stories=(\d+)-(\d*)", OPTS).groups()
+        if OPTS and "stories=" in OPTS
+        else None
+    )
+    if story_range:
+        start, end = story_range
+        story_range = (int(start), int(end) if end else None)
+    port = (
+        int(re.search(r"port=(\d+)", OPTS).group(1))
+        if OPTS and "port=" in OPTS
+        else PORT + shard
+    )
+    index_type = (
+        re.search(r"index=(\w+)", OPTS).group(1)
+        if OPTS and "index=" in OPTS
+        else os.getenv("INDEX_TYPE", search.Index.INDEX_TYPE)
+    )
+    nlist = (
+        int(re.search(r"nlist=(\d+)", OPTS).group(1))
+        if OPTS and "nlist=" in OPTS
+        else search.Index.NLIST
+    )
+    nprobe = (
+        int(re.search(r"nprobe=(\d+)", OPTS).group(1))
+        if OPTS and "nprobe=" in OPTS
+        else search.Index.NPROBE
+    )
+    workers = (
+        int(re.search(r"workers=(\d+)", OPTS).group(1))
+        if OPTS and "workers=" in OPTS
+        else search.Index.WORKERS
+    )
+    metric = (
+        re.search(r"metric=(\w+)", OPTS).group(1)
+        if OPTS and "metric=" in OPTS
+        else search.Index.METRIC
+    )
+    coarse_dim = (
+        int(re.search(r"dims=(\d+)", OPTS).group(1))
+        if OPTS and "dims=" in OPTS
+        else None
+    )
+
+    # Load story metadata for filtered search
+    lp = LogPhase(f"loaded story metadata for shard {shard}")
+    story_metadata = metadata.StoryMetadata(db_conn, story_range)
+    lp.stop()
+
+    # Load vector search
+    lp = LogPhase(f"loaded vector search index for shard {shard}")
+    search_index = search.Index(
+        embed_conn,
+        None,
+        f"{prefix}_embeddings_shard{shard}.faiss",
+        store=store.VectorStore(
+            embed_conn,
+            f"{prefix}_embeddings.store",
+            read_only=True if OPTS and "shared_store" in OPTS else False,
+        ),
+        metadata=story_metadata,
+        index_type=index_type,
+        nlist=nlist,
+        nprobe=nprobe,
+        workers=workers,
+        story_range=story_range,
+        coarse_dim=coarse_dim,
+        metric=metric,
+        rebuild=reindex,
+    )
+    lp.stop()
+
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="0.0.0.0", port=port, log_level="warning")
+    )
+    await server.serve()
+
+    print(f"Exiting shard {shard}...")
+    if search_index.dirty:
+        search_index.save_index()
+    await search_index.close()
+    db_conn.close()
+    embed_conn.close()
+
+
+if __name__ == "__main__":
+    if not DB_PATH:
+        print("Set DB_PATH to path of hn-sqlite.db")
+        exit()
+
+    db_path = os.path.expanduser(DB_PATH)
+    db_conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+
+    prefix = os.path.splitext(db_path)[0]
+    embed_conn = sqlite3.connect(
+        f"file:{prefix}_embeddings.db?mode=ro", uri=True, check_same_thread=False
+    )
+
+    asyncio.run(main(db_conn, embed_conn, prefix))
@@ -0,0 +1,193 @@
+import os
+import json
+import sqlite3
+import numpy as np
+
+from utils import log, log_with_mem
+
+
+class VectorStore:
+    CHUNK_SIZE = 65536
+    EMBEDDING_DIM = 1536
+
+    def __init__(self, embed_conn, path, dim=EMBEDDING_DIM, read_only=False):
+        self.embed_conn = embed_conn
+        self.path = path
+        self.dim = dim
+        # Shards started by main.py share a store that only main.py writes
+        self.read_only = read_only
+        self.max_id = 0
+        self.count = 0
+
+        # Row-aligned flat files: float32 vectors, story IDs and embeddings.id
+        self.vectors_path = os.path.join(path, "vectors.f32")
+        self.stories_path = os.path.join(path, "stories.i64")
+        self.rows_path = os.path.join(path, "rows.i64")
+        self.meta_path = os.path.join(path, "meta.json")
+
+    def sync(self, compact=True):
+        meta = self.read_meta()
+        if self.read_only:
+            if not meta or meta["dirty"] or meta["dim"] != self.dim:
+                raise RuntimeError(f"vector store {self.path} is not in sync")
+            self.max_id, self.count = meta["max_id"], meta["count"]
+            return
+        os.makedirs(self.path, exist_ok=True)
+        if not meta or meta["dirty"] or meta["dim"] != self.dim:
+            log(f"exporting embeddings to {self.path}")
+            self.max_id, self.count = 0, 0
+        else:
+            self.max_id, self.count = meta["max_id"], meta["count"]
+
+        # Anything past the recorded count is from an interrupted sync
+        self.truncate()
+        if compact:
+            self.drop_deleted()
+        self.append_new()
+        # Local shards share the store, so leave it untouched when current
+        if meta != {
+            "max_id": self.max_id,
+            "count": self.count,
+            "dim": self.dim,
+            "dirty": False,
+        }:
+            self.write_meta(dirty=False)
+        log_with_mem(f"vector store in sync ({self.count} vectors)")
+
+    def load(self):
+        if self.count == 0:
+            return (
+                np.empty((0, self.dim), dtype=np.float32),
+                np.empty(0, dtype=np.int64),
+            )
+        vectors = np.memmap(
+            self.vectors_path, dtype=np.float32, mode="r", shape=(self.count, self.dim)
+        )
+        story_ids = np.memmap(
+            self.stories_path, dtype=np.int64, mode="r", shape=(self.count,)
+        )
+        return vectors, story_ids
+
+    def live_rows(self):
+        # Rows whose embedding is still in the DB, None when all of them are
+        cursor = self.embed_conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM embeddings WHERE id <= ?", (self.max_id,))
+        if cursor.fetchone()[0] == self.count:
+            cursor.close()
+            return None
+        cursor.execute("SELECT id FROM embeddings WHERE id <= ?", (self.max_id,))
+        current = np.fromiter((row[0] for row in cursor), dtype=np.int64)
+        cursor.close()
+        rows = np.memmap(self.rows_path, dtype=np.int64, mode="r", shape=(self.count,))
+        return np.flatnonzero(np.isin(rows, current))
+
+    def truncate(self):
+        for path, row_size in (
+            (self.vectors_path, self.dim * 4),
+            (self.stories_path, 8),
+            (self.rows_path, 8),
+        ):
+            with open(path, "ab") as f:
+                f.truncate(self.count * row_size)
+
+    def drop_deleted(self):
+        live_rows = self.live_rows()
+        if live_rows is None:
+            return
+
+        # Compact the live rows towards the front of each file, chunk by chunk
+        self.write_meta(dirty=True)
+        live = np.zeros(self.count, dtype=bool)
+        live[live_rows] = True
+        rows = np.memmap(self.rows_path, dtype=np.int64, mode="r+", shape=(self.count,))
+        stories = np.memmap(
+            self.stories_path, dtype=np.int64, mode="r+", shape=(self.count,)
+        )
+        vectors = np.memmap(
+            self.vectors_path, dtype=np.float32, mode="r+", shape=(self.count, self.dim)
+        )
+        dest = 0
+        for start in range(0, self.count, self.CHUNK_SIZE):
+            mask = live[start : start + self.CHUNK_SIZE]
+            kept = int(mask.sum())
+            for array in (rows, stories, vectors):
+                array[dest : dest + kept] = array[start : start + self.CHUNK_SIZE][mask]
+            dest += kept
+        for array in (rows, stories, vectors):
+            array.flush()
+        rows, stories, vectors = None, None, None
+
+        log(f"dropped {self.count - dest} deleted embeddings from vector store")
+        self.count = dest
+        self.truncate()
+
+    def append_new(self):
+        cursor = self.embed_conn.cursor()
+        cursor.execute(
+            "SELECT id, story, embedding FROM embeddings WHERE id > ? ORDER BY id",
+            (self.max_id,),
+        )
+        with open(self.vectors_path, "ab") as vectors_file, open(
+            self.stories_path, "ab"
+        ) as stories_file, open(self.rows_path, "ab") as rows_file:
+            while True:
+                batch = cursor.fetchmany(self.CHUNK_SIZE)
+                if not batch:
+                    break
+                row_ids, story_ids, embeddings = zip(*batch)
+                vectors_file.write(b"".join(embeddings))
+                stories_file.write(np.array(story_ids, dtype=np.int64).tobytes())
+                rows_file.write(np.array(row_ids, dtype=np.int64).tobytes())
+                self.count += len(batch)
+                self.max_id = row_ids[-1]
+        cursor.close()
+
+    def read_meta(self):
+        if not os.path.exists(self.meta_path):
+            return None
+        with open(self.meta_path, "r") as f:
+            return json.load(f)
+
+    def write_meta(self, dirty):
+        tmp_path = f"{self.meta_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "max_id": self.max_id,
+                    "count": self.count,
+                    "dim": self.dim,
+                    "dirty": dirty,
+                },
+                f,
+            )
+        os.replace(tmp_path, self.meta_path)
+
+
+class StoryRows:
+    # Finds all rows of a set of stories in an unsorted story ID column,
+    # optionally only among the given rows
+    def __init__(self, story_ids, rows=None):
+        if rows is None:
+            self.order = np.argsort(story_ids, kind="stable")
+        else:
+            self.order = rows[np.argsort(story_ids[rows], kind="stable")]
+        self.sorted_ids = np.asarray(story_ids)[self.order]
+
+    def lookup(self, story_ids):
+        starts = np.searchsorted(self.sorted_ids, story_ids, side="left")
+        ends = np.searchsorted(self.sorted_ids, story_ids, side="right")
+        rows = [self.order[start:end] for start, end in zip(starts, ends)]
+        # Sorted rows keep memory-mapped reads close to sequential
+        return np.sort(np.concatenate(rows)) if rows else np.empty(0, dtype=np.int64)
+
+
+DB_PATH = os.getenv("DB_PATH")
+if __name__ == "__main__":
+    if not DB_PATH:
+        print("Set DB_PATH to path of hn-sqlite.db")
+        exit()
+
+    prefix = os.path.splitext(os.path.expanduser(DB_PATH))[0]
+    embed_conn = sqlite3.connect(f"file:{prefix}_embeddings.db?mode=ro", uri=True)
+    VectorStore(embed_conn, f"{prefix}_embeddings.store").sync()
+    embed_conn.close()
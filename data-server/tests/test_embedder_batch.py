@@ -0,0 +1,125 @@
+import os
+import sys
+import random
+import sqlite3
+
+import pytest
+import tiktoken
+
+from tiktoken._educational import bpe_train
+
+DATA_SERVER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The cl100k_base split pattern, its vocabulary is downloaded on first use
+CL100K_PATTERN = r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}++|\p{N}{1,3}+| ?[^\s\p{L}\p{N}]++[\r\n]*+|\s++$|\s*[\r\n]|\s+(?!\S)|\s"""
+WORDS = [
+    "the", "quick", "brown", "fox", "über", "naïve", "日本語", "🙂", "1234567",
+    "don't", "it's", "<|endoftext|>", "&amp;", "!!", "?\n", "\n\n", "  ", "\t",
+    "...", "x", "http://a.b/c?d=1", "  \n", "\r\n", " \t ", "€", "<p>",
+]  # fmt: skip
+
+
+def random_text(rng, words):
+    return "".join(
+        rng.choice(WORDS) + rng.choice(["", " ", "  ", "\n"]) for _ in range(words)
+    )
+
+
+@pytest.fixture(scope="module")
+def embedder_batch():
+    # A small vocabulary trained on the same split pattern stands in for
+    # cl100k_base, what matters is that pieces are encoded the same way
+    rng = random.Random(0)
+    ranks = bpe_train(
+        random_text(rng, 1500) + "\t\tfoo bar\n\t\t\tbaz\n" * 20,
+        256 + 100,
+        CL100K_PATTERN,
+        visualise=None,
+    )
+    encoding = tiktoken.Encoding(
+        "test",
+        pat_str=CL100K_PATTERN,
+        mergeable_ranks=ranks,
+        special_tokens={"<|endoftext|>": len(ranks)},
+    )
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.syspath_prepend(DATA_SERVER)
+        monkeypatch.delitem(sys.modules, "embedder_batch", raising=False)
+        monkeypatch.setattr(tiktoken, "get_encoding", lambda name: encoding)
+        import embedder_batch
+
+        yield embedder_batch
+
+
+@pytest.fixture
+def db_conn():
+    rng = random.Random(1)
+    db_conn = sqlite3.connect(":memory:")
+    db_conn.row_factory = sqlite3.Row
+    db_conn.execute(
+        "CREATE TABLE items (id INTEGER PRIMARY KEY, type TEXT, title TEXT, "
+        "text TEXT, parent INTEGER)"
+    )
+    rows, next_id = [], 1
+    for story in range(20):
+        story_id, next_id = next_id, next_id + 1
+        text = None if story % 3 else random_text(rng, 20)
+        rows.append((story_id, "story", f"story {story}", text, None))
+        parents = [story_id]
+        for _ in range(rng.randint(0, 120)):
+            text = rng.choice(
+                [None, "[dead]", "<p>hi &amp; bye</p>"]
+                + [random_text(rng, rng.randint(1, 40)), random_text(rng, 300)]
+            )
+            rows.append((next_id, "comment", None, text, rng.choice(parents)))
+            parents.append(next_id)
+            next_id += 1
+    db_conn.executemany("INSERT INTO items VALUES (?, ?, ?, ?, ?)", rows)
+    return db_conn
+
+
+def test_document_tokens_match_full_encoding(embedder_batch):
+    rng = random.Random(2)
+    for _ in range(500):
+        document = random_text(rng, rng.randint(0, 5))
+        tokens = embedder_batch.DocumentTokens(document)
+        for _ in range(rng.randint(1, 10)):
+            text = random_text(rng, rng.randint(0, 4))
+            expected = embedder_batch.token_len(document + text)
+            assert tokens.count_with(text) == expected
+            if rng.random() < 0.7:
+                tokens.append(text)
+                document += text
+
+
+class FullTokens:
+    # What create_documents_bfs did before, re-encode the whole document
+    def __init__(self, token_len, text=""):
+        self.token_len = token_len
+        self.text = text
+
+    def count_with(self, text):
+        return self.token_len(self.text + text)
+
+    def append(self, text):
+        self.text += text
+
+
+@pytest.mark.parametrize("token_limit", [60, 150, 400, 8000])
+def test_documents_match_full_encoding(
+    embedder_batch, db_conn, monkeypatch, token_limit
+):
+    doc_embedder = embedder_batch.DocumentEmbedder(db_conn)
+    doc_embedder.TOKEN_LIMIT = token_limit
+    constraint = "FROM items WHERE type = 'story' ORDER BY id"
+    documents = doc_embedder.get_story_documents(constraint)
+
+    monkeypatch.setattr(
+        embedder_batch,
+        "DocumentTokens",
+        lambda text="": FullTokens(embedder_batch.token_len, text),
+    )
+    expected = doc_embedder.get_story_documents(constraint)
+    assert len(expected) > 20
+    assert [
+        (story_id, part, text.encode("utf-8")) for story_id, part, text in documents
+    ] == [(story_id, part, text.encode("utf-8")) for story_id, part, text in expected]
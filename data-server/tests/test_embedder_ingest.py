@@ -0,0 +1,152 @@
+import os
+import sys
+import json
+import base64
+import sqlite3
+
+import numpy as np
+import pytest
+
+DATA_SERVER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EMBEDDING_DIM = 1536
+
+
+def embedding(seed):
+    vector = np.random.default_rng(seed).standard_normal(EMBEDDING_DIM)
+    return (vector / np.linalg.norm(vector)).astype(np.float32)
+
+
+def result_line(story, part, seed=None, encoding="float"):
+    # The shape of a Batch API output line, failed requests have no response
+    custom_id = f"{story}-{part}"
+    if seed is None:
+        error = {"code": "server_error", "message": "The server had an error"}
+        return {"id": f"batch_req_{custom_id}", "custom_id": custom_id, "error": error}
+    vector = embedding(seed)
+    if encoding == "base64":
+        data = base64.b64encode(vector.tobytes()).decode()
+    else:
+        data = vector.tolist()
+    body = {
+        "object": "list",
+        "data": [{"object": "embedding", "index": 0, "embedding": data}],
+        "model": "text-embedding-3-small",
+    }
+    return {
+        "id": f"batch_req_{custom_id}",
+        "custom_id": custom_id,
+        "response": {"status_code": 200, "request_id": custom_id, "body": body},
+        "error": None,
+    }
+
+
+@pytest.fixture
+def embedder_ingest(monkeypatch):
+    monkeypatch.syspath_prepend(DATA_SERVER)
+    for name in ("search", "store", "utils"):
+        monkeypatch.delitem(sys.modules, name, raising=False)
+    import embedder_ingest
+
+    return embedder_ingest
+
+
+@pytest.fixture
+def ingest(embedder_ingest, tmp_path):
+    embed_conn = sqlite3.connect(tmp_path / "hn_embeddings.db")
+    embed_conn.execute(
+        "CREATE TABLE embeddings "
+        "(id INTEGER PRIMARY KEY AUTOINCREMENT, story INTEGER, embedding BLOB)"
+    )
+    # An embedding of story 2 from before the batch workflow
+    embed_conn.execute(
+        "INSERT INTO embeddings (story, embedding) VALUES (2, ?)",
+        (embedding(99).tobytes(),),
+    )
+    embed_conn.commit()
+    runs = []
+
+    def ingest(*lines):
+        path = tmp_path / f"batch_{len(runs)}_output.jsonl"
+        path.write_text("".join(json.dumps(line) + "\n" for line in lines))
+        ingester = embedder_ingest.BatchIngester(embed_conn)
+        ingester.ensure_tables()
+        ingester.ingest_file(path)
+        ingester.remove_stale_parts()
+        runs.append(ingester)
+        return ingester
+
+    yield ingest, embed_conn
+    embed_conn.close()
+
+
+def rows(embed_conn):
+    return embed_conn.execute(
+        "SELECT p.story, p.part, e.id, e.embedding FROM batch_parts p "
+        "JOIN embeddings e ON e.id = p.id ORDER BY p.story, p.part"
+    ).fetchall()
+
+
+def test_ingest_results(ingest):
+    ingest, embed_conn = ingest
+    ingester = ingest(
+        result_line(1, 0, seed=1),
+        result_line(1, 1, seed=2, encoding="base64"),
+        result_line(1, 2, seed=3),
+        result_line(2, 0, seed=4, encoding="base64"),
+        result_line(2, 1),
+    )
+    assert (ingester.inserted, ingester.failed) == (4, 1)
+    assert [(story, part) for story, part, _, _ in rows(embed_conn)] == [
+        (1, 0),
+        (1, 1),
+        (1, 2),
+        (2, 0),
+    ]
+    for (story, part, _, blob), seed in zip(rows(embed_conn), [1, 2, 3, 4]):
+        assert np.frombuffer(blob, dtype=np.float32).tolist() == (
+            embedding(seed).tolist()
+        )
+    # The older embedding of story 2 was replaced, nothing else is left
+    (count,) = embed_conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+    assert count == 4
+
+
+def test_identical_rerun_keeps_ids(ingest):
+    ingest, embed_conn = ingest
+    lines = [result_line(1, part, seed=part) for part in range(3)]
+    ingest(*lines)
+    before = rows(embed_conn)
+    ingester = ingest(*lines)
+    assert (ingester.inserted, ingester.unchanged, ingester.removed) == (0, 3, 0)
+    assert rows(embed_conn) == before
+
+
+def test_reingest_with_fewer_parts(ingest):
+    ingest, embed_conn = ingest
+    ingest(*[result_line(1, part, seed=part) for part in range(3)])
+    (max_id,) = embed_conn.execute("SELECT MAX(id) FROM embeddings").fetchone()
+
+    ingester = ingest(result_line(1, 0, seed=0), result_line(1, 1, seed=1))
+    assert (ingester.inserted, ingester.removed) == (0, 1)
+    assert [(story, part) for story, part, _, _ in rows(embed_conn)] == [
+        (1, 0),
+        (1, 1),
+    ]
+    (count,) = embed_conn.execute(
+        "SELECT COUNT(*) FROM embeddings WHERE story = 1"
+    ).fetchone()
+    assert count == 2
+    # New IDs, so persisted indexes replay the story without its last part
+    assert all(row_id > max_id for _, _, row_id, _ in rows(embed_conn))
+
+
+def test_failed_part_keeps_earlier_embedding(ingest):
+    ingest, embed_conn = ingest
+    ingest(*[result_line(1, part, seed=part) for part in range(3)])
+    before = rows(embed_conn)
+
+    ingester = ingest(
+        result_line(1, 0, seed=0), result_line(1, 1), result_line(1, 2, seed=2)
+    )
+    assert (ingester.inserted, ingester.failed, ingester.removed) == (0, 1, 0)
+    assert rows(embed_conn) == before
@@ -0,0 +1,82 @@
+import os
+import sys
+import sqlite3
+
+import numpy as np
+import pytest
+
+DATA_SERVER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EMBEDDING_DIM = 1536
+STORIES = 300
+
+
+@pytest.fixture
+def modules(monkeypatch):
+    monkeypatch.syspath_prepend(DATA_SERVER)
+    for name in ("search", "store", "metadata", "utils"):
+        monkeypatch.delitem(sys.modules, name, raising=False)
+    import search
+    import metadata
+
+    # Force the faiss selector path, small candidate sets are otherwise
+    # scanned exactly from the DB
+    monkeypatch.setattr(search.Index, "EXACT_SEARCH_STORIES", 0)
+    return search, metadata
+
+
+@pytest.fixture
+def conns():
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((2 * STORIES, EMBEDDING_DIM)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    db_conn = sqlite3.connect(":memory:")
+    db_conn.execute(
+        "CREATE TABLE items (id INTEGER PRIMARY KEY, type TEXT, time INTEGER, "
+        "score INTEGER, descendants INTEGER, by TEXT)"
+    )
+    db_conn.executemany(
+        "INSERT INTO items VALUES (?, 'story', ?, ?, 0, 'pg')",
+        [(story, story, story % 10) for story in range(1, STORIES + 1)],
+    )
+    embed_conn = sqlite3.connect(":memory:")
+    embed_conn.execute(
+        "CREATE TABLE embeddings "
+        "(id INTEGER PRIMARY KEY AUTOINCREMENT, story INTEGER, embedding BLOB)"
+    )
+    # Two chunks per story
+    embed_conn.executemany(
+        "INSERT INTO embeddings (story, embedding) VALUES (?, ?)",
+        [(row // 2 + 1, vector.tobytes()) for row, vector in enumerate(vectors)],
+    )
+    return db_conn, embed_conn, vectors
+
+
+@pytest.mark.parametrize("index_type", ["ivfflat", "hnsw"])
+@pytest.mark.parametrize("metric", ["l2", "cosine"])
+def test_filtered_search(modules, conns, index_type, metric):
+    search, metadata = modules
+    db_conn, embed_conn, vectors = conns
+    index = search.Index(
+        embed_conn,
+        None,
+        metadata=metadata.StoryMetadata(db_conn),
+        index_type=index_type,
+        nlist=4,
+        nprobe=4,
+        workers=1,
+        metric=metric,
+    )
+    # The query's own story has score 0 and is filtered out
+    query = vectors[20:21]
+    results = index.search_embeddings(query, 10, filters={"min_score": 5})[0]
+    index.executor.shutdown()
+    index.rebuild_executor.shutdown()
+
+    stories = np.arange(2 * STORIES) // 2 + 1
+    allowed = stories % 10 >= 5
+    distances = search.Index.exact_distances(query, vectors[allowed], metric)[0]
+    expected = []
+    for row in np.argsort(distances, kind="stable"):
+        if stories[allowed][row] not in expected:
+            expected.append(stories[allowed][row])
+    assert [story for story, _ in results] == expected[:10]
@@ -31,6 +31,7 @@ class SyncService:
         self.telemetry = telemetry
 
         self.search_index = None
+        self.story_metadata = None
 
     async def run(self):
         updates = None
@@ -126,6 +127,9 @@ class SyncService:
             self.db_conn.commit()
         cursor.close()
 
+        if self.story_metadata is not None:
+            self.story_metadata.update(items)
+
     def insert_users(self, users):
         cursor = self.db_conn.cursor()
         for user in users: